@@ -0,0 +1,10 @@
+import logging
+import asyncio
+import sys
+from . import web
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(web.main(*sys.argv[1:2]))
+    loop.run_forever()
@@ -0,0 +1,48 @@
+import asyncio
+import contextlib
+import importlib
+import io
+import sys
+import time
+
+SUITES = ['atm.cashcode.bench', 'atm.cctalk.bench', 'atm.lcdm2.bench', 'atm.sber.bench']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def measure(call, count, concurrency=1):
+    latencies = []
+    left = iter(range(count))
+    async def worker():
+        for i in left:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+    wall, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    return latencies, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def report(title, latencies, wall, cpu):
+    n = len(latencies)
+    print('%-32s n=%-5d p50 %8.2f ms  p99 %8.2f ms  %8.1f cmd/s  %7.1f us cpu/cmd' % (
+        title, n, percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+        n / wall, cpu / n * 1e6))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    for name in SUITES:
+        module = importlib.import_module(name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = asyncio.run(module.bench_bus(count))
+        for title, result in results.items():
+            if isinstance(result, tuple):
+                report('%s %s' % (name.split('.')[1], title), *result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+CACHE_DIR = os.environ.get('ATM_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'atm'))
+MAX_AGE = 7 * 24 * 3600
+
+
+def cache_path(*names):
+    name = '-'.join(re.sub(r'[^A-Za-z0-9_.]+', '_', str(n)).strip('_') for n in names)
+    return os.path.join(CACHE_DIR, name + '.json')
+
+
+class Cache:
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def load(self):
+        if self.data is None:
+            try:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+            except FileNotFoundError:
+                self.data = {}
+            except Exception as e:
+                logging.error('cache %s unreadable: %r', self.path, e)
+                self.data = {}
+        return self.data
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def stale(self, key, max_age=MAX_AGE):
+        entry = self.get(key)
+        return entry is None or time.time() - entry.get('cached', 0) > max_age
+
+    def latest(self, field):
+        # newest entry for every value of field, e.g. the last device seen at each address
+        out = {}
+        for entry in sorted(self.load().values(), key=lambda e: e.get('cached', 0)):
+            if field in entry:
+                out[entry[field]] = entry
+        return out
+
+    def set(self, key, value):
+        value = dict(value, cached=time.time())
+        self.load()[key] = value
+        self.save()
+        return value
+
+    def pop(self, key):
+        value = self.load().pop(key, None)
+        self.save()
+        return value
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error('cache %s not saved: %r', self.path, e)
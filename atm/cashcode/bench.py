@@ -0,0 +1,79 @@
+import asyncio
+import random
+import sys
+import timeit
+
+from . import protocol, emulator
+from ..bench import measure, report
+from ..emulator import nodelay
+
+
+def GetCRC16_bitwise(data):
+    crc = 0
+    for b in data:
+        crc ^= b
+        for j in range(0, 8):
+            if (crc & 0x0001):
+                crc >>= 1
+                crc ^= 0x8408
+            else:
+                crc >>= 1
+    return crc.to_bytes(2,'little')
+
+
+def random_frames(count=1000, seed=0):
+    rnd = random.Random(seed)
+    frames = []
+    for i in range(count):
+        param = bytes(rnd.randrange(256) for _ in range(rnd.randrange(0, 250)))
+        frames.append(bytes([protocol.SYNC, rnd.choice([1, 2, 3]), len(param)+6, rnd.randrange(256), *param]))
+    return frames
+
+
+def bench_crc(frames, number=20):
+    results = {}
+    for name, func in [
+            ('bitwise', GetCRC16_bitwise),
+            ('GetCRC16', protocol.GetCRC16),
+            ('CRC16.update', lambda d: protocol.CRC16(d).digest())
+    ]:
+        t = min(timeit.repeat(lambda: [func(f) for f in frames], number=number, repeat=3))
+        results[name] = t / number / len(frames)
+    return results
+
+
+async def bench_bus(count=200, gap=protocol.INTERFRAME_GAP, delay=0):
+    server, device, url = await emulator.serve(emulator.BillValidator(delay=delay, init_polls=1))
+    cc = protocol.CCNET(url, gap=gap)
+    await (await cc.open())
+    nodelay(cc.transport)
+    await cc.reset()
+    await cc.enable()
+    results = {}
+    results['poll'] = await measure(cc.poll, count)
+    results['status'] = await measure(lambda: cc.command(protocol.STATUS), count)
+    bills = max(1, count // 10)
+    for i in range(bills):
+        device.insert(i % 8)
+    results['stack_one'] = await measure(cc.stack_one, bills)
+    await cc.close()
+    server.close()
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    gap = float(sys.argv[2]) if len(sys.argv) > 2 else protocol.INTERFRAME_GAP
+    for title, result in asyncio.run(bench_bus(count // 5, gap)).items():
+        report('emulator %s' % title, *result)
+    frames = random_frames(count)
+    poll = [protocol.command(protocol.POLL, b'', protocol.VALIDATOR)[:-2]] * len(frames)
+    for title, data in [('random frames', frames), ('poll frames', poll)]:
+        results = bench_crc(data)
+        base = results['bitwise']
+        for name, t in results.items():
+            print('%-14s %-14s %8.2f us/frame  x%.1f' % (title, name, t * 1e6, base / t))
+
+
+if __name__ == "__main__":
+    main()
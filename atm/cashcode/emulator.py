@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import sys
+
+from . import protocol
+from ..emulator import listen
+from .protocol import (
+    SYNC, ACK, ILLEGAL, RESET, STATUS, SET_SECURITY, POLL, SET_BILL_TABLE,
+    STACK, RETURN, IDENTIFICATION, HOLD, GET_BILL_TABLE, CCNETProtocol, GetCRC16
+)
+
+POWER_UP = 0x10
+INITIALIZE = 0x13
+IDLING = 0x14
+ACCEPTING = 0x15
+STACKING = 0x17
+RETURNING = 0x18
+DISABLED = 0x19
+
+RUB = [(10, 0), (50, 0), (100, 0), (200, 0), (5, 2), (1, 3), (2, 3), (5, 3)]
+
+
+def bill_table(bills=RUB, country=b'RUS'):
+    data = b''
+    for i in range(24):
+        if i < len(bills):
+            value, scale = bills[i]
+            data += bytes([value]) + country + bytes([scale])
+        else:
+            data += bytes(5)
+    return data
+
+
+class BillValidator:
+    def __init__(self, adr=protocol.VALIDATOR, delay=0.005, init_polls=3, stack_polls=2):
+        self.adr = adr
+        self.delay = delay
+        self.init_polls = init_polls
+        self.stack_polls = stack_polls
+        self.state = POWER_UP
+        self.param = None
+        self.countdown = 0
+        self.enabled = False
+        self.bills = []
+        self.stacked = []
+        self.transport = None
+        self.frames = 0
+
+    def insert(self, index):
+        self.bills.append(index)
+
+    def frame(self, data):
+        f = bytes([SYNC, self.adr, len(data)+5, *data])
+        return f + GetCRC16(f)
+
+    def reply(self, data):
+        frame = self.frame(data)
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self.write, frame)
+        else:
+            self.write(frame)
+
+    def write(self, frame):
+        if self.transport:
+            self.transport.write(frame)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def next_state(self):
+        if self.state == POWER_UP:
+            return
+        if self.state == INITIALIZE:
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.state = IDLING if self.enabled else DISABLED
+        elif self.state in [protocol.STATE_STACKED, protocol.STATE_RETURNED]:
+            self.state = IDLING if self.enabled else DISABLED
+            self.param = None
+        elif self.state == STACKING:
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.stacked.append(self.param)
+                self.state = protocol.STATE_STACKED
+        elif self.state == RETURNING:
+            self.state = protocol.STATE_RETURNED
+        elif self.state == ACCEPTING:
+            self.state = protocol.STATE_ESCROW
+        elif self.state == IDLING and self.bills:
+            self.param = self.bills.pop(0)
+            self.state = ACCEPTING
+
+    def on_command(self, cmd, param):
+        if cmd == POLL:
+            state = bytes([self.state]) if self.param is None else bytes([self.state, self.param])
+            self.next_state()
+            return state
+        elif cmd == RESET:
+            self.state = INITIALIZE
+            self.countdown = self.init_polls
+            self.enabled = False
+            return bytes([ACK])
+        elif cmd == SET_BILL_TABLE:
+            self.enabled = any(param[:3])
+            if self.state in [IDLING, DISABLED]:
+                self.state = IDLING if self.enabled else DISABLED
+            return bytes([ACK])
+        elif cmd == STACK:
+            if self.state in [protocol.STATE_ESCROW, protocol.STATE_HOLDING]:
+                self.state = STACKING
+                self.countdown = self.stack_polls
+            return bytes([ACK])
+        elif cmd == RETURN:
+            if self.state in [protocol.STATE_ESCROW, protocol.STATE_HOLDING]:
+                self.state = RETURNING
+            return bytes([ACK])
+        elif cmd == HOLD:
+            if self.state == protocol.STATE_ESCROW:
+                self.state = protocol.STATE_HOLDING
+            return bytes([ACK])
+        elif cmd == SET_SECURITY:
+            return bytes([ACK])
+        elif cmd == STATUS:
+            return b'\xff\xff\xff\x00\x00\x00'
+        elif cmd == IDENTIFICATION:
+            return b'SM-RU1353     '.ljust(15) + b'41K000000001' + bytes(7)
+        elif cmd == GET_BILL_TABLE:
+            return bill_table()
+        return bytes([ILLEGAL])
+
+    def on_frame(self, adr, raw, head):
+        self.frames += 1
+        if adr != self.adr:
+            return
+        data = raw[head:-2]
+        if data == bytes([ACK]):
+            return
+        self.reply(self.on_command(data[0], data[1:]))
+
+
+async def serve(device=None, host='127.0.0.1', port=0):
+    device = device or BillValidator()
+    server, url = await listen(lambda: CCNETProtocol(device), host, port)
+    return server, device, url
+
+
+async def main():
+    server, device, url = await serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print(url)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -4,6 +4,11 @@ import serial_asyncio
 import serial
 import functools
 import traceback
+import collections
+from ..events import Broadcast, Claims
+from .. import metrics
+from ..cache import Cache, cache_path
+from ..trace import WireTrace, debug
 
 
 RESET = 0x30
@@ -62,25 +67,76 @@ STATE_STACKED = 0x81
 STATE_RETURNED = 0x82
 STATE_HOLDING = 0x1a
 
+# reported by a single POLL reply, unlike states the device stays in
+ONESHOT_STATES = [STATE_STACKED, STATE_RETURNED]
+FAULT_STATES = [0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x47]
+
+POLL_INTERVAL = 0.2
+
+CRC16_POLY = 0x8408
+
+
+def _crc16_table(poly=CRC16_POLY):
+    table = []
+    for b in range(256):
+        crc = b
+        for j in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ poly
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table()
+
+
+class CRC16:
+    __slots__ = ('crc',)
+
+    def __init__(self, data=b'', crc=0):
+        self.crc = crc
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        crc = self.crc
+        table = CRC16_TABLE
+        for b in data:
+            crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+        self.crc = crc
+        return self
+
+    def digest(self):
+        return self.crc.to_bytes(2, 'little')
+
+    def copy(self):
+        return CRC16(crc=self.crc)
+
+
 def GetCRC16(data):
     crc = 0
+    table = CRC16_TABLE
     for b in data:
-        crc ^= b
-        for j in range(0, 8):
-            if (crc & 0x0001):
-                crc >>= 1
-                crc ^= 0x8408
-            else:
-                crc >>= 1
-    return crc.to_bytes(2,'little')
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+    return crc.to_bytes(2, 'little')
 
 
+@functools.lru_cache(maxsize=256)
 def command(cmd, param, adr):
     lng = len(param)+6
     data = bytes([SYNC,adr,lng,cmd,*param])
     data += GetCRC16(data)
     return data
 
+
+@functools.lru_cache(maxsize=16)
+def ack(adr):
+    data = bytes([SYNC,adr,6,ACK])
+    data += GetCRC16(data)
+    return data
+
 async def timeouted(delay, future):
     t = asyncio.get_running_loop().call_later(delay, future.cancel)
     try:
@@ -91,8 +147,13 @@ async def timeouted(delay, future):
     finally:
         t.cancel()
 
+B2B = 0x01
 VALIDATOR = 0x03
 COIN = 0x02
+# peripheral addresses CCNET assigns, anything else after SYNC is noise
+ADDRESSES = range(0x01, 0x0f)
+# longer frames carry LNG 0 and a two byte length
+MAX_SHORT_FRAME = 250
 
 ASK_EXCEPTIONS = {
     NAK: Exception(NAK, 'NAK response'),
@@ -100,22 +161,247 @@ ASK_EXCEPTIONS = {
 }
 
 
+MAX_FRAME = 4096
+
+
+class CCNETProtocol(asyncio.Protocol):
+    def __init__(self, device):
+        self.device = device
+        self.metrics = getattr(device, 'metrics', None)
+        self.transport = None
+        self.buf = bytearray()
+        self.crc = None
+        self.crc_len = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.device.decoder = self
+        self.device.connection_made(transport)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.device.connection_lost(exc)
+
+    def header(self, buf, start, size):
+        """(length, head) of a frame starting at start, None if incomplete, False if implausible."""
+        if size - start < 3:
+            return None
+        if buf[start+1] not in ADDRESSES:
+            return False
+        lng = buf[start+2]
+        head = 3
+        if lng == 0:
+            if size - start < 5:
+                return None
+            lng = int.from_bytes(buf[start+3:start+5], 'big')
+            head = 5
+            if lng <= MAX_SHORT_FRAME or lng > MAX_FRAME:
+                return False
+        elif lng > MAX_SHORT_FRAME or lng < head + 3:
+            return False
+        return lng, head
+
+    def frame_after(self, view, buf, start, size):
+        # a complete frame with a good CRC inside the bytes a pending header claims
+        pos = buf.find(SYNCb, start + 1, size)
+        while pos >= 0:
+            header = self.header(buf, pos, size)
+            if header and pos + header[0] <= size:
+                end = pos + header[0]
+                if CRC16(view[pos:end-2]).digest() == view[end-2:end]:
+                    return True
+            pos = buf.find(SYNCb, pos + 1, size)
+        return False
+
+    def resync(self):
+        # the pending frame start was noise: drop its SYNC and rescan the rest
+        self.crc = None
+        if self.buf:
+            del self.buf[:1]
+            self.data_received(b'')
+
+    def data_received(self, data):
+        buf = self.buf
+        buf += data
+        if self.metrics and data:
+            self.metrics.rx(len(data))
+        view = memoryview(buf)
+        size = len(buf)
+        pos = 0
+        try:
+            while pos < size:
+                start = buf.find(SYNCb, pos)
+                if start < 0:
+                    logging.debug('skip %d bytes', size - pos)
+                    pos = size
+                    break
+                if start > pos:
+                    logging.debug('skip %d bytes', start - pos)
+                    pos = start
+                header = self.header(buf, start, size)
+                if header is None:
+                    break
+                if header is False:
+                    if self.metrics:
+                        self.metrics.error('framing')
+                    pos = start + 1
+                    self.crc = None
+                    continue
+                lng, head = header
+                end = start + lng
+                crc_start = start + self.crc_len if self.crc is not None else start
+                crc = self.crc or CRC16()
+                crc.update(view[crc_start:min(size, end-2)])
+                if end > size:
+                    if self.frame_after(view, buf, start, size):
+                        logging.debug('frame inside pending one at %d, resync', start)
+                        if self.metrics:
+                            self.metrics.error('framing')
+                        pos = start + 1
+                        self.crc = None
+                        continue
+                    self.crc, self.crc_len = crc, min(size, end-2) - start
+                    break
+                self.crc = None
+                if view[end-2:end] != crc.digest():
+                    logging.debug('bad crc at %d, resync', start)
+                    if self.metrics:
+                        self.metrics.error('crc')
+                    pos = start + 1
+                    continue
+                raw = bytes(view[start:end])
+                pos = end
+                self.device.on_frame(raw[1], raw, head)
+        finally:
+            view.release()
+            if pos:
+                del buf[:pos]
+
+
+# bus silence the controller keeps before sending the next frame
+INTERFRAME_GAP = 0.02
+RESPONSE_TIMEOUT = 1
+
+
+class CommandScheduler:
+    def __init__(self, send, gap=INTERFRAME_GAP, timeout=RESPONSE_TIMEOUT, metrics=None, on_timeout=None):
+        self.send = send
+        self.on_timeout = on_timeout
+        self.metrics = metrics
+        self.gap = gap
+        self.timeout = timeout
+        self.queues = collections.OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.current = None
+        self.last_activity = 0
+        self.task = None
+
+    def submit(self, adr, cmd, frame, void=False):
+        loop = asyncio.get_running_loop()
+        resf = loop.create_future()
+        self.queues.setdefault(adr, collections.deque()).append((cmd, frame, resf, void))
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return resf
+
+    def activity(self):
+        self.last_activity = asyncio.get_running_loop().time()
+
+    def reply(self, adr):
+        if self.current and self.current[0] == adr:
+            _, cmd, resf = self.current
+            self.current = None
+            return cmd, resf
+        return None, None
+
+    def next_job(self):
+        for adr in list(self.queues):
+            queue = self.queues[adr]
+            self.queues.move_to_end(adr)
+            while queue:
+                job = queue.popleft()
+                if not job[2].done():
+                    return adr, job
+            del self.queues[adr]
+        return None, None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            adr, job = self.next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            cmd, frame, resf, void = job
+            delay = self.last_activity + self.gap - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if resf.done():
+                continue
+            waitf = loop.create_future() if void else resf
+            self.current = adr, cmd, waitf
+            try:
+                self.send(frame)
+            except Exception as e:
+                self.current = None
+                resf.set_exception(e)
+                continue
+            if void:
+                resf.set_result(None)
+            start = loop.time()
+            await asyncio.wait([waitf], timeout=self.timeout)
+            if not waitf.done():
+                waitf.cancel()
+                if self.metrics:
+                    self.metrics.error('timeout')
+                if self.on_timeout:
+                    self.on_timeout()
+            elif self.metrics:
+                self.metrics.observe(cmd, loop.time() - start)
+            if self.current and self.current[2] is waitf:
+                self.current = None
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        for queue in self.queues.values():
+            for job in queue:
+                job[2].cancel()
+        self.queues.clear()
+
+
 class CCNET:
     def __init__(
             self,
             dev=None,
             baudrate=19200,
-            adr=0x03
+            adr=0x03,
+            gap=INTERFRAME_GAP,
+            timeout=RESPONSE_TIMEOUT,
+            poll_interval=POLL_INTERVAL,
+            cache=None
     ):
         self.nominals = {}
+        self.identification = {}
+        self.cache = Cache(cache or cache_path('cashcode', dev))
         self.baudrate = baudrate
         self.adr = adr
         self.dev = dev
         self.opened = asyncio.Future()
-        self.responces = {}
-        self.read_task = None
+        self.metrics = metrics.register('cashcode', dev, baudrate)
+        self.trace = WireTrace('cashcode:%s' % dev)
+        self.bus = CommandScheduler(self.send, gap=gap, timeout=timeout, metrics=self.metrics, on_timeout=self.resync)
+        self.transport = None
+        self.decoder = None
         self.state = {}
         self.state_param = {}
+        self.poll_interval = poll_interval
+        self.pollers = {}
+        self.events = {}
+        self.credits = {}
+        self.last_poll = {}
         self.opened.set_result(False)
 
     async def enable_coin(self, adr=None):
@@ -136,41 +422,128 @@ class CCNET:
 
 
     async def close(self):
-        self.writer.transport.close()
-
-    async def open(self):
+        for poller in self.pollers.values():
+            poller.cancel()
+        self.pollers.clear()
+        self.bus.close()
+        transport, self.transport = self.transport, None
+        if transport:
+            transport.close()
+        metrics.unregister(self.metrics)
+        self.trace.close()
+
+    async def disconnect(self):
+        # only the port: pollers and subscribers carry on once it is back
+        transport, self.transport = self.transport, None
+        if transport:
+            transport.close()
+
+    def resume(self):
+        # a poller for every address somebody still listens to
+        for adr, hub in self.events.items():
+            if len(hub) and (adr not in self.pollers or self.pollers[adr].done()):
+                self.pollers[adr] = asyncio.get_running_loop().create_task(self.poller(adr))
+
+    async def open(self, retry=True):
         loop = asyncio.get_running_loop()
-        self.opened = asyncio.Future()
+        # retries resolve the future the first caller is waiting on
+        if self.opened.done():
+            self.opened = asyncio.Future()
         try:
-            self.reader, self.writer = await serial_asyncio.open_serial_connection(
-                url=self.dev, 
-                baudrate=self.baudrate, 
-                timeout=5, 
-                rtscts=0, 
-                parity=serial.PARITY_NONE, 
-                stopbits=serial.STOPBITS_ONE 
+            await serial_asyncio.create_serial_connection(
+                loop,
+                functools.partial(CCNETProtocol, self),
+                url=self.dev,
+                baudrate=self.baudrate,
+                timeout=5,
+                rtscts=0,
+                parity=serial.PARITY_NONE,
+                stopbits=serial.STOPBITS_ONE
                 )
-            self.read_task = loop.create_task(self.readforever(self.reader,  self.writer, self.opened))
         except Exception as e:
+            if not retry:
+                raise
             logging.error(repr(e))
             logging.error(traceback.format_exc())
-            loop.call_later(5, functools.partial(loop.create_task, self.open()))
+            loop.call_later(5, lambda: loop.create_task(self.open()))
         return self.opened
 
     async def stack_one(self, adr=None):
         adr = adr or self.adr
-        resp = await self.wait_state( states=[STATE_ESCROW, STATE_HOLDING, STATE_STACKED], adr=adr)
-        if resp.get('credit') and resp['state'] in [STATE_ESCROW, STATE_HOLDING]:
-            await self.command(STACK, adr=adr)
-            resp = await self.wait_state( states=[STATE_STACKED], adr=adr)
-        return resp
-
-    async def wait_state(self, states=[], adr=None):
+        # every stacked bill is claimed by one caller, concurrent callers wait for their own
+        credits = self.credits.setdefault(adr, Claims())
+        credit = asyncio.ensure_future(credits.claim())
+        try:
+            with self.subscribe(adr) as events:
+                fresh = False
+                while True:
+                    escrow = asyncio.ensure_future(self.wait_state(
+                        states=[STATE_ESCROW, STATE_HOLDING], adr=adr, events=events, fresh=fresh))
+                    await asyncio.wait([credit, escrow], return_when=asyncio.FIRST_COMPLETED)
+                    if credit.done():
+                        escrow.cancel()
+                        return credit.result()
+                    if escrow.result().get('credit'):
+                        await self.command(STACK, adr=adr)
+                    fresh = True
+        finally:
+            credit.cancel()
+
+    async def wait_state(self, states=[], adr=None, events=None, fresh=False):
         adr = adr or self.adr
-        resp = None
-        while resp is None or resp['state'] not in states:
-            resp = await self.poll(adr)
-        return resp
+        if events is None:
+            with self.subscribe(adr) as events:
+                return await self.wait_state(states, adr, events, fresh)
+        last = self.last_poll.get(adr)
+        if not fresh and last and last['state'] in states and last['state'] not in ONESHOT_STATES:
+            return last
+        async for resp in events:
+            if resp.get('state') in states:
+                return resp
+
+    def subscribe(self, adr=None, maxsize=0):
+        adr = adr or self.adr
+        hub = self.events.setdefault(adr, Broadcast())
+        if adr not in self.pollers or self.pollers[adr].done():
+            self.pollers[adr] = asyncio.get_running_loop().create_task(self.poller(adr))
+        return hub.subscribe(maxsize)
+
+    async def poller(self, adr):
+        loop = asyncio.get_running_loop()
+        task = self.pollers.get(adr)
+        delay = self.poll_interval
+        while True:
+            start = loop.time()
+            error = None
+            try:
+                await self.poll(adr)
+            except asyncio.CancelledError:
+                if self.pollers.get(adr) is not task:
+                    raise
+                error = 'timeout'
+            except Exception as e:
+                logging.error(repr(e))
+                error = repr(e)
+            if error is None:
+                delay = self.poll_interval
+            else:
+                if delay == self.poll_interval:
+                    self.last_poll.pop(adr, None)
+                    self.events[adr].publish({'adr': adr, 'error': error, 'fault': True})
+                delay = min(delay * 2, 5)
+            await asyncio.sleep(max(0, start + delay - loop.time()))
+
+    def on_state(self, adr, resp):
+        last = self.last_poll.get(adr)
+        self.last_poll[adr] = resp
+        if (last and last['state'] == resp['state'] and last['state_param'] == resp['state_param']
+                and resp['state'] not in ONESHOT_STATES):
+            return
+        hub = self.events.get(adr)
+        if hub:
+            hub.publish(resp)
+        if resp['state'] == STATE_STACKED and resp.get('credit') and adr in self.credits:
+            self.credits[adr].publish(resp)
 
     async def poll(self, adr=None):
         adr = adr or self.adr
@@ -188,60 +561,80 @@ class CCNET:
         elif adr == COIN:
             s.append(await self.command(0x08, adr=adr, void=True))
         while self.state[adr] in [0x00,0x13]:
-            await asyncio.sleep(1)
+            await asyncio.sleep(self.poll_interval)
             s.append(await self.poll(adr))
-        if adr == VALIDATOR or adr == 1:
-            s.append(await self.command(GET_BILL_TABLE, adr=adr))
-        elif adr == COIN:
-            s.append(await self.command(GET_COIN_TABLE, adr=adr))
+        s.append(await self.load_table(adr))
         return s
 
-    async def write(self,data):
-        await asyncio.sleep(0.1)
-        logging.debug('< %s',data.hex())
-        self.writer.write(data)
-        await self.writer.drain()        
+    def preload(self):
+        for adr, entry in self.cache.latest('adr').items():
+            self.nominals[adr] = entry['nominals']
+
+    async def load_table(self, adr=None):
+        # part number and serial identify the unit and its firmware, the table is fixed per pair
+        adr = adr or self.adr
+        ident = await self.command(IDENTIFICATION, adr=adr)
+        key = '%s:%s' % (ident['part'], ident['serial'])
+        entry = self.cache.get(key)
+        if entry and entry.get('adr') == adr:
+            self.nominals[adr] = entry['nominals']
+            if self.cache.stale(key):
+                asyncio.get_running_loop().create_task(self.refresh_table(adr, key))
+            return {'adr': adr, 'cmd': GET_BILL_TABLE, 'cached': key}
+        return await self.refresh_table(adr, key)
+
+    async def refresh_table(self, adr, key):
+        if adr == VALIDATOR or adr == 1:
+            resp = await self.command(GET_BILL_TABLE, adr=adr)
+        else:
+            return await self.command(GET_COIN_TABLE, adr=adr)
+        self.cache.set(key, {'adr': adr, 'nominals': self.nominals[adr]})
+        return resp
+
+    def send(self, data):
+        self.trace.tx(data)
+        if debug():
+            logging.debug('< %s',data.hex())
+        self.transport.write(data)
+        if self.metrics:
+            self.metrics.tx(len(data))
+        self.bus.activity()
 
     async def command(self, cmd, param=b'', adr=VALIDATOR, void=False):
         o = await self.opened
         if not o:
             raise Exception('COM not connected')
-        if not void:
-            resf = asyncio.Future()
-            self.responces[adr] = cmd, resf
-        data = command(cmd, param, adr)
-        await self.write(data)
-        if not void:
-            result = await timeouted(10, resf)
-            return result
-
-    async def on_reply(self, adr, raw):
-        data = raw[3:-2]
-        logging.debug(data)
+        resf = self.bus.submit(adr, cmd, command(cmd, param, adr), void)
+        if void:
+            return await resf
+        try:
+            return await timeouted(10, resf)
+        except asyncio.CancelledError:
+            if self.transport is not None:
+                self.trace.dump('timeout on 0x%02x' % cmd)
+            raise
+
+    def on_reply(self, adr, raw, head=3):
+        data = raw[head:-2]
         resp = {
             'adr': adr, 'raw': raw
         }
 
         if len(data) != 1 or data[0] not in [ACK, NAK, ILLEGAL]:
-            ack = bytes([SYNC,adr,6,0])
-            ack += GetCRC16(ack)
-            await self.write(ack)
-            logging.debug('ask')
-        
+            self.send(ack(adr))
+
         elif len(data) == 1:
             if data[0] == ACK:
                 resp['error'] = None
             elif data[0] in ASK_EXCEPTIONS.keys():
                 resp['error'] = ASK_EXCEPTIONS[data[0]]
+                if self.metrics:
+                    self.metrics.error('nak' if data[0] == NAK else 'illegal')
             #return
 
-        logging.debug(resp)
-        logging.debug(self.responces)
-
-        if adr in self.responces.keys():
-            cmd, respf = self.responces.pop(adr)
-            
-            if respf.cancelled():
+        cmd, respf = self.bus.reply(adr)
+        if respf is not None:
+            if respf.done():
                 return #
 
             resp['cmd'] = cmd
@@ -252,12 +645,20 @@ class CCNET:
                 resp['state'] = self.state[adr]
                 resp['state_param'] = self.state_param[adr]
                 if state in [STATE_ESCROW, STATE_RETURNED, STATE_STACKED]:
-                    resp['credit'] = [self.nominals[adr][param]]
+                    nominals = self.nominals.get(adr)
+                    resp['credit'] = [nominals[param] if nominals else None]
+                if state in FAULT_STATES:
+                    resp['fault'] = True
+                self.on_state(adr, resp)
+            elif cmd == IDENTIFICATION:
+                resp['part'] = data[0:15].decode(errors='replace').strip()
+                resp['serial'] = data[15:27].decode(errors='replace').strip()
+                resp['asset'] = data[27:34]
+                self.identification[adr] = resp
             elif cmd == STATUS:
                 resp['bill_types'] = data[0:3]
                 resp['security'] = data[3:6]
             elif cmd == GET_BILL_TABLE:
-                logging.debug('# %s', data.hex())
                 if data[0] == b'0':
                     respf.set_exception(Exception('wrong state'))
                 resp['bill_table'] = [ ]
@@ -274,36 +675,38 @@ class CCNET:
                         resp['bill_table'].append(
                             btn
                         )
+            if debug():
+                logging.debug(resp)
             respf.set_result(resp)
 
 
-    async def readforever(self, reader, writer, opened):
-        loop = asyncio.get_running_loop()
-        try:
-            opened.set_result(True)
-            while True:
-                logging.info('reading')
-                data = await reader.readexactly(1)
-                if data[0] == SYNC:
-                    data += await reader.readexactly(2)
-                    _, adr, lng = data
-                    if lng:
-                        pass
-                    else:
-                        logging.error('Not implemented long commands')
-                    data += await reader.readexactly(lng-3)
-                    if data[-2:] == GetCRC16(data[:-2]):
-                        logging.debug('> %s', data.hex())
-                        loop.create_task(self.on_reply(adr, data))
-
-                else:
-                    logging.error(data)
-
-        except serial.SerialException as e:
-            logging.error(repr(e))
-            logging.error(traceback.format_exc())
-            loop.create_task(self.open())
-            raise e
+    def on_frame(self, adr, raw, head):
+        self.bus.activity()
+        self.trace.rx(raw)
+        if debug():
+            logging.debug('> %s', raw.hex())
+        self.on_reply(adr, raw, head)
+
+    def resync(self):
+        # no answer in time: whatever the decoder holds back is not our reply
+        if self.decoder:
+            self.decoder.resync()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.opened.done():
+            self.opened = asyncio.Future()
+        self.opened.set_result(True)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.opened = asyncio.Future()
+        self.opened.set_result(False)
+        if exc:
+            logging.error(repr(exc))
+            self.trace.dump('connection lost')
+            loop = asyncio.get_running_loop()
+            loop.call_later(5, lambda: loop.create_task(self.open()))
 
 
 
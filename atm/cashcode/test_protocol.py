@@ -0,0 +1,61 @@
+from . import protocol
+from .bench import GetCRC16_bitwise, random_frames
+
+
+def test_crc():
+    # table driven CRC against the reference bitwise one, whole and in chunks
+    for data in random_frames(1000):
+        expected = GetCRC16_bitwise(data)
+        assert protocol.GetCRC16(data) == expected, data.hex()
+        assert protocol.CRC16(data).digest() == expected, data.hex()
+        crc = protocol.CRC16()
+        for i in range(0, len(data), 7):
+            crc.update(data[i:i+7])
+        assert crc.digest() == expected, data.hex()
+
+
+class Frames:
+    metrics = None
+
+    def __init__(self):
+        self.frames = []
+
+    def on_frame(self, adr, raw, head):
+        self.frames.append(raw)
+
+
+def decode(*chunks):
+    device = Frames()
+    decoder = protocol.CCNETProtocol(device)
+    for chunk in chunks:
+        decoder.data_received(chunk)
+    return device.frames, decoder
+
+
+REPLY = protocol.command(protocol.ACK, b'', protocol.VALIDATOR)
+
+
+def test_decode_split():
+    frames, decoder = decode(*[REPLY[i:i+1] for i in range(len(REPLY))])
+    assert frames == [REPLY]
+
+
+def test_decode_stray_sync():
+    # a stray SYNC claiming a long frame must not hold back the real reply
+    assert decode(b'\x02\x03\xf0' + REPLY)[0] == [REPLY]
+    assert decode(b'\x02\x03\xf0', REPLY)[0] == [REPLY]
+
+
+def test_decode_implausible_header():
+    # unknown address, short length over 250, extended length that fits a short frame
+    for noise in [b'\x02\x7f\x10', b'\x02\x03\xfb', b'\x02\x03\x00\x00\x10']:
+        assert decode(noise, REPLY)[0] == [REPLY], noise.hex()
+
+
+def test_decode_resync_on_timeout():
+    frames, decoder = decode(b'\x02\x03\x00\x10\x00' + REPLY[:3])
+    assert frames == [] and decoder.buf.startswith(b'\x02\x03\x00\x10')
+    decoder.resync()
+    assert decoder.buf == REPLY[:3]
+    decoder.data_received(REPLY[3:])
+    assert frames == [REPLY]
@@ -1,26 +1,30 @@
 import aiohttp
 from aiohttp import web
 from . import protocol
+from ..web import dumps, HTTPUnreachable, prometheus
 import logging
 import asyncio
 import json
 
 
-def dumps(o):
-    def enc(w):
-        if type(w) == bytes:
-            return w.hex()
-        else:
-            return repr(w)
-    return json.dumps(o, default=enc)
+def check_ready(request):
+    init = request.app.cc_init
+    if not init['ready']:
+        raise web.HTTPServiceUnavailable(content_type="application/json", text=dumps(init))
+    return request.app.cc
 
 
-class HTTPUnreachable(web.HTTPError):
-    status_code = 523
+async def health(request):
+    init = request.app.cc_init
+    return web.json_response(init, dumps=dumps, status=200 if init['ready'] else 503)
 
+async def nominals(request):
+    # answered from the descriptor cache while the validator is still starting
+    cc = request.app.cc
+    return web.json_response(cc.nominals.get(cc.adr) or [], dumps=dumps)
 
 async def enable(request):
-    cc = request.app.cc
+    cc = check_ready(request)
     try:
         data = await cc.enable()
     except asyncio.CancelledError as e:
@@ -28,7 +32,7 @@ async def enable(request):
     return web.json_response(data, dumps=dumps)
 
 async def disable(request):
-    cc = request.app.cc
+    cc = check_ready(request)
     try:
         data = await cc.disable()
     except asyncio.CancelledError as e:
@@ -36,7 +40,7 @@ async def disable(request):
     return web.json_response(data, dumps=dumps)
 
 async def status(request):
-    cc = request.app.cc
+    cc = check_ready(request)
     try:
         data = await cc.poll()
     except asyncio.CancelledError as e:
@@ -45,35 +49,128 @@ async def status(request):
 
 
 async def get_bill(request):
-    cc = request.app.cc
+    cc = check_ready(request)
     try:
         data = await protocol.timeouted(30, asyncio.ensure_future(cc.stack_one()))
     except Exception as e:
         data = {'error': str(e)}
     return web.json_response(data, dumps=dumps)
 
+SSE_BUFFER = 64
+SSE_KEEPALIVE = 15
+
+
+def event_name(data):
+    if data.get('fault'):
+        return 'fault'
+    if data.get('credit') and data.get('state') == protocol.STATE_STACKED:
+        return 'credit'
+    return 'state'
+
+
+async def events(request):
+    cc = request.app.cc
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await resp.prepare(request)
+    with cc.subscribe(maxsize=SSE_BUFFER) as sub:
+        try:
+            last = cc.last_poll.get(cc.adr)
+            if last:
+                await resp.write(('event: state\ndata: %s\n\n' % dumps(last)).encode())
+            dropped = 0
+            while True:
+                try:
+                    data = await asyncio.wait_for(sub.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await resp.write(b': keepalive\n\n')
+                    continue
+                if sub.dropped != dropped:
+                    await resp.write(('event: dropped\ndata: %d\n\n' % (sub.dropped - dropped)).encode())
+                    dropped = sub.dropped
+                await resp.write(('event: %s\ndata: %s\n\n' % (event_name(data), dumps(data))).encode())
+        except ConnectionResetError:
+            pass
+    return resp
+
+
+INIT_RETRY = 5
+
+
+async def initialize(app):
+    init = app.cc_init
+    cc = app.cc
+    while not init['ready']:
+        try:
+            init['stage'] = 'connecting'
+            await (await cc.open(retry=False))
+            init['stage'] = 'reset'
+            s = await cc.reset()
+            logging.info(s)
+            init['stage'] = 'identification'
+            status, security = await asyncio.gather(
+                cc.command(protocol.STATUS),
+                cc.command(protocol.SET_SECURITY, b'\xff\xff\xff'),
+            )
+            ident = cc.identification.get(cc.adr) or await cc.command(protocol.IDENTIFICATION)
+            logging.info(status)
+            logging.info(ident)
+            logging.info(security)
+            init['identification'] = ident.get('raw')
+            init['error'] = None
+            init['stage'] = 'ready'
+            init['ready'] = True
+            cc.resume()
+        except asyncio.CancelledError:
+            if init['stage'] == 'stopped':
+                raise
+            init['error'] = 'timeout at %s' % init['stage']
+        except Exception as e:
+            logging.exception(e)
+            init['error'] = repr(e)
+        init['elapsed'] = asyncio.get_running_loop().time() - init['started']
+        if not init['ready']:
+            logging.error('cashcode init failed: %s', init['error'])
+            await cc.disconnect()
+            await asyncio.sleep(INIT_RETRY)
+
+async def shutdown(app):
+    app.cc_init['stage'] = 'stopped'
+    app.cc_init_task.cancel()
+    await app.cc.close()
+
 async def setup(app, config):
     port = config.get('com')
     baudrate = config.get('baudrate', 9600)
     addr = config.get('adr', 3)
     assert port, "No port in config"
-    app.cc = protocol.CCNET(port, adr=addr, baudrate=9600)
-    await (await app.cc.open())
-    s = await app.cc.reset()
-    logging.info(s)
-    logging.info(await app.cc.command(0x31))
-    logging.info(await app.cc.command(0x37))
-    logging.info(await app.cc.command(0x32, b'\xff\xff\xff'))
+    app.cc = protocol.CCNET(port, adr=addr, baudrate=9600, poll_interval=config.get('poll_interval', protocol.POLL_INTERVAL))
+    app.cc.preload()
+    app.cc_init = {
+        'ready': False,
+        'stage': 'starting',
+        'error': None,
+        'started': asyncio.get_running_loop().time()
+    }
+    app.cc_init_task = asyncio.get_running_loop().create_task(initialize(app))
+    app.on_cleanup.append(shutdown)
+    app.router.add_get('/atm/cashcode/health', health)
+    app.router.add_get('/atm/cashcode/nominals', nominals)
     app.router.add_post('/atm/cashcode/status', status)
     app.router.add_post('/atm/cashcode/get_bill', get_bill)
     app.router.add_post('/atm/cashcode/enable', enable)
     app.router.add_post('/atm/cashcode/disable', disable)
+    app.router.add_get('/atm/cashcode/events', events)
 
 async def main():
     app = web.Application()
     import toml
     config = toml.load('config.ini').get('cashcode', {})
     await setup(app, config)
+    app.router.add_get('/metrics', prometheus)
     runner = web.AppRunner(app)
     await runner.setup()
     config = toml.load('config.ini').get('web', {})
@@ -0,0 +1,131 @@
+import asyncio
+import sys
+import timeit
+
+from . import protocol, emulator
+from .protocol import Commands
+from ..bench import measure, report
+from ..emulator import nodelay
+
+
+def add_status(text, n=1):
+    def parse(resp, head):
+        resp.setdefault('status',[])
+        resp['status'].append({'code':head[0], "description": text})
+        return n, resp
+    return parse
+
+def currencys_data(evtype, text, sign = 1):
+    def parse(resp, head):
+        resp.setdefault('status',[])
+        resp.setdefault(evtype,[])
+        resp['status'].append({'code':head[0], "description": text})
+        number = head[1]
+        n = 2 + number * 7
+        while number>0:
+            number-=1
+            curr = head[2+number*7:][:7]
+            resp[evtype].append({
+                'denomination': sign * int.from_bytes(curr[:4], 'little')/100,
+                'country': curr[4:],
+                'code': head[0]
+            })
+        return n, resp
+    return parse
+
+def currency_data(evtype, text, sign = 1):
+    def parse(resp, head):
+        resp.setdefault(evtype,[])
+        curr = head[1:][:7]
+        resp[evtype].append({
+                'denomination': sign * int.from_bytes(curr[:4], 'little')/100,
+                'country': curr[4:],
+                'code': head[0]
+            })
+        return 8, resp
+    return parse
+
+
+legacy_parsers = {
+    0x00: add_status('Idle'),
+    0x01: currencys_data('processing', 'Dispensing'),
+    0x02: currencys_data('credit', 'Dispensed', -1),
+    0x03: add_status('Coins Low'),
+    0x04: add_status('Empty'),
+    0x05: currencys_data('processing','Jammed'),
+    0x06: currencys_data('processing','Halted'),
+    0x07: currencys_data('processing','Floating'),
+    0x08: currencys_data('processing','Floated'),
+    0x09: currencys_data('processing','Timeout'),
+    0x0a: currencys_data('processing','Incomplete payout'),
+    0x0b: currencys_data('processing','Incomplete float'),
+    0x0c: currencys_data('credit','Cashbox paid'),
+    0x0d: currency_data('credit','Coin credit'),
+    0x11: add_status('Disabled'),
+    0x13: add_status('Slave reset'),
+    0x24: add_status('Calibration fault', 2),
+}
+
+
+def legacy_parse_status_c(resp):
+    data = resp['raw']
+    i = 0
+    while i < len(data):
+        code = data[i]
+        b, resp = legacy_parsers[code](resp, data[i:])
+        i += b
+    return resp
+
+
+def records(code, coins):
+    return bytes([code, len(coins)]) + b''.join(emulator.currency(v, c) for v, c in coins)
+
+
+# payloads as a smart hopper reports them, from idle to a long payout
+STATUS_PAYLOADS = {
+    'idle': b'\x00',
+    'coin credit': b'\x0d' + emulator.currency(1000, b'RUB'),
+    'payout': records(0x01, emulator.COINS[:2]) + b'\x03',
+    'payout done': records(0x02, emulator.COINS * 4) + records(0x0c, emulator.COINS * 2) + b'\x00',
+}
+
+
+def bench_status_c(payloads=STATUS_PAYLOADS, number=20000):
+    results = {}
+    for name, raw in payloads.items():
+        results[name] = [
+            min(timeit.repeat(lambda: func({'raw': raw}), number=number, repeat=3)) / number
+            for func in (legacy_parse_status_c, protocol.parse_status_c)
+        ]
+    return results
+
+
+async def bench_bus(count=200, delay=0):
+    server, devices, url = await emulator.serve([
+        emulator.SmartHopper(adr=3), emulator.SmartHopper(adr=2, serial=b'\x02\x02\x02')
+    ], delay=delay)
+    ct = protocol.CCTalk(url, adr=3)
+    await (await ct.open())
+    nodelay(ct.writer.transport)
+    await ct.init(adrs=[2, 3])
+    results = {}
+    results['simple poll'] = await measure(lambda: ct.command(Commands.Simple_Poll), count)
+    results['status'] = await measure(ct.status, count)
+    results['buffered events'] = await measure(lambda: ct.command(229), count)
+    results['poll_all 2 devices'] = await measure(lambda: ct.poll_all(229), count)
+    results['status 2 clients'] = await measure(lambda: asyncio.gather(ct.status(adr=2), ct.status(adr=3)), count)
+    ct.writer.close()
+    server.close()
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for title, result in asyncio.run(bench_bus(count)).items():
+        report('emulator %s' % title, *result)
+    for name, (old, new) in bench_status_c().items():
+        print('status_c %-14s closures %7.2f us  struct %7.2f us  x%.1f' % (name, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import sys
+
+from .protocol import Commands, checksum
+from ..emulator import listen
+
+COINS = [(100, b'RUB'), (200, b'RUB'), (500, b'RUB'), (1000, b'RUB')]
+
+
+def currency(value, country):
+    return value.to_bytes(4, 'little') + country
+
+
+class SmartHopper:
+    def __init__(self, adr=3, coins=COINS, level=100, serial=b'\x01\x02\x03', software=b'SH3-1.0'):
+        self.adr = adr
+        self.coins = list(coins)
+        self.levels = [level] * len(self.coins)
+        self.serial = serial
+        self.software = software
+        self.inhibit = True
+        self.status = []
+        self.counter = 0
+        self.buffer = []
+
+    def event(self, code, data=b''):
+        self.status.append(bytes([code]) + data)
+
+    def buffered(self, result, code=0):
+        self.counter = self.counter % 255 + 1
+        self.buffer.insert(0, bytes([result, code]))
+        del self.buffer[5:]
+
+    def insert(self, channel):
+        value, country = self.coins[channel - 1]
+        self.levels[channel - 1] += 1
+        self.event(0x0d, currency(value, country))
+        self.buffered(channel)
+
+    def payout(self, amount):
+        paid = []
+        for i in sorted(range(len(self.coins)), key=lambda i: -self.coins[i][0]):
+            value, country = self.coins[i]
+            while amount >= value and self.levels[i]:
+                amount -= value
+                self.levels[i] -= 1
+                paid.append(currency(value, country))
+        self.event(0x02, bytes([len(paid)]) + b''.join(paid))
+        return amount
+
+    def on_command(self, cmd, data):
+        if cmd in [Commands.Simple_Poll, Commands.Reset_Device, Commands.Empty,
+                   Commands.Run_Unit_Calibration, Commands.Set_Peripheral_Device_Master_Inhibit,
+                   Commands.Set_Note_Inhibit_Channels]:
+            return b''
+        elif cmd == Commands.Set_Master_Inhibit_Status:
+            self.inhibit = not (data and data[0])
+            self.event(0x11 if self.inhibit else 0x00)
+            return b''
+        elif cmd == Commands.Request_Manufacturer_ID:
+            return b'ITL'
+        elif cmd == Commands.Request_Equipment_Category_ID:
+            return b'SMART_HOPPER'
+        elif cmd == Commands.Request_Product_Code:
+            return b'SH3'
+        elif cmd == Commands.Request_Serial_Number:
+            return self.serial
+        elif cmd == Commands.Request_Software_Revision:
+            return self.software
+        elif cmd == Commands.Get_Device_Setup_c:
+            return bytes([len(self.coins)]) + b''.join(currency(*c) for c in self.coins)
+        elif cmd == Commands.Request_Status_c:
+            status = b''.join(self.status) or b'\x00'
+            self.status = []
+            return status
+        elif cmd == Commands.Payout_Amount_c:
+            self.payout(int.from_bytes(data[:4], 'little'))
+            return b''
+        elif cmd in [Commands.Read_Buffered_Bill_Events, 229]:
+            return bytes([self.counter]) + b''.join(self.buffer).ljust(10, b'\x00')
+        return None
+
+
+BILLS = [b'RU0050A', b'RU0100A', b'RU0500A', b'RU1000A']
+
+
+class BillValidator(SmartHopper):
+    def __init__(self, adr=40, bills=BILLS, serial=b'\x04\x05\x06', software=b'BV-1.0', escrow=False):
+        super().__init__(adr, serial=serial, software=software)
+        self.bills = list(bills)
+        self.escrow = escrow
+
+    def insert(self, bill_type):
+        if self.escrow:
+            self.buffered(bill_type, 1)
+        self.buffered(bill_type, 0)
+
+    def on_command(self, cmd, data):
+        if cmd == Commands.Request_Equipment_Category_ID:
+            return b'Bill Validator'
+        elif cmd == Commands.Request_Bill_id:
+            return self.bills[data[0] - 1] if data[0] <= len(self.bills) else b'.......'
+        elif cmd == Commands.Request_Country_Scaling_Factor:
+            return bytes([100, 0, 2])
+        return super().on_command(cmd, data)
+
+
+class CCTalkBus(asyncio.Protocol):
+    def __init__(self, devices, delay=0.002, echo=False):
+        self.devices = {d.adr: d for d in devices}
+        self.delay = delay
+        self.echo = echo
+        self.buf = bytearray()
+        self.transport = None
+        self.frames = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        if self.transport and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def later(self, delay, data):
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.write, data)
+        else:
+            self.write(data)
+
+    def data_received(self, data):
+        self.buf += data
+        while len(self.buf) >= 5 and len(self.buf) >= 5 + self.buf[1]:
+            n = 5 + self.buf[1]
+            frame = bytes(self.buf[:n])
+            del self.buf[:n]
+            if self.echo:
+                self.write(frame)
+            self.on_frame(frame)
+
+    def on_frame(self, frame):
+        if sum(frame) % 256:
+            return
+        self.frames += 1
+        dest, lng, src, cmd = frame[:4]
+        data = frame[4:-1]
+        if cmd == Commands.Address_Poll and dest == 0:
+            # each device answers with its bare address after 4 ms * address
+            for adr in self.devices:
+                self.later(0.004 * adr, bytes([adr]))
+            return
+        device = self.devices.get(dest)
+        if device is None:
+            return
+        reply = device.on_command(cmd, data)
+        if reply is None:
+            return
+        self.later(self.delay, checksum(bytes([src, len(reply), dest, 0]) + reply + b'\x00'))
+
+
+async def serve(devices=None, host='127.0.0.1', port=0, **kw):
+    devices = devices or [SmartHopper()]
+    server, url = await listen(lambda: CCTalkBus(devices, **kw), host, port)
+    return server, devices, url
+
+
+async def main():
+    server, devices, url = await serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print(url)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -4,68 +4,94 @@ import traceback
 import functools
 import logging
 import serial
-
-def add_status(text, n=1):
-    def parse(resp, head):
-        resp.setdefault('status',[])
-        resp['status'].append({'code':head[0], "description": text})
-        return n, resp
-    return parse
-
-def currencys_data(evtype, text, sign = 1):
-    def parse(resp, head):
-        resp.setdefault('status',[])
-        resp.setdefault(evtype,[])
-        resp['status'].append({'code':head[0], "description": text})
-        number = head[1]
-        n = 2 + number * 7
-        while number>0:
-            number-=1
-            curr = head[2+number*7:][:7]
-            resp[evtype].append({
-                'denomination': sign * int.from_bytes(curr[:4], 'little')/100,
-                'country': curr[4:],
-                'code': head[0]
-            })
-        return n, resp
-    return parse
-
-def currency_data(evtype, text, sign = 1):
-    def parse(resp, head):  
-        resp.setdefault(evtype,[])
-        curr = head[1:][:7]
-        resp[evtype].append({
-                'denomination': sign * int.from_bytes(curr[:4], 'little')/100,
-                'country': curr[4:],
-                'code': head[0]
-            })
-        return 8, resp
-    return parse
-
-
-
-
-status_c_parsers = {
-    0x00: add_status('Idle'),
-    0x01: currencys_data('processing', 'Dispensing'),
-    0x02: currencys_data('credit', 'Dispensed', -1),
-    0x03: add_status('Coins Low'),
-    0x04: add_status('Empty'),
-    0x05: currencys_data('processing','Jammed'),
-    0x06: currencys_data('processing','Halted'),
-    0x07: currencys_data('processing','Floating'),
-    0x08: currencys_data('processing','Floated'),
-    0x09: currencys_data('processing','Timeout'),
-    0x0a: currencys_data('processing','Incomplete payout'),
-    0x0b: currencys_data('processing','Incomplete float'),
-    0x0c: currencys_data('credit','Cashbox paid'),
-    0x0d: currency_data('credit','Coin credit'),
-    0x11: add_status('Disabled'),
-    0x13: add_status('Slave reset'),
-    0x24: add_status('Calibration fault', 2),
+import struct
+import collections
+from .. import metrics
+from ..trace import WireTrace, debug
+from ..cache import Cache, cache_path
+from ..events import Broadcast, Claims
+
+STATUS, CURRENCY, CURRENCIES = range(3)
+
+CURRENCY_RECORD = struct.Struct('<I3s')
+
+
+class CurrencyEvent:
+    __slots__ = ('denomination', 'country', 'code')
+
+    def __init__(self, denomination, country, code):
+        self.denomination = denomination
+        self.country = country
+        self.code = code
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return 'CurrencyEvent(%r, %r, 0x%02x)' % (self.denomination, self.country, self.code)
+
+    def _asdict(self):
+        return {'denomination': self.denomination, 'country': self.country, 'code': self.code}
+
+
+# code: (kind, description, event list, sign or status length)
+status_c_events = {
+    0x00: (STATUS, 'Idle', None, 1),
+    0x01: (CURRENCIES, 'Dispensing', 'processing', 1),
+    0x02: (CURRENCIES, 'Dispensed', 'credit', -1),
+    0x03: (STATUS, 'Coins Low', None, 1),
+    0x04: (STATUS, 'Empty', None, 1),
+    0x05: (CURRENCIES, 'Jammed', 'processing', 1),
+    0x06: (CURRENCIES, 'Halted', 'processing', 1),
+    0x07: (CURRENCIES, 'Floating', 'processing', 1),
+    0x08: (CURRENCIES, 'Floated', 'processing', 1),
+    0x09: (CURRENCIES, 'Timeout', 'processing', 1),
+    0x0a: (CURRENCIES, 'Incomplete payout', 'processing', 1),
+    0x0b: (CURRENCIES, 'Incomplete float', 'processing', 1),
+    0x0c: (CURRENCIES, 'Cashbox paid', 'credit', 1),
+    0x0d: (CURRENCY, 'Coin credit', 'credit', 1),
+    0x11: (STATUS, 'Disabled', None, 1),
+    0x13: (STATUS, 'Slave reset', None, 1),
+    0x24: (STATUS, 'Calibration fault', None, 2),
 }
 
 
+def parse_status_c(resp):
+    raw = resp['raw']
+    n = len(raw)
+    data = memoryview(raw) if n > 8 else raw
+    i = 0
+    while i < n:
+        code = raw[i]
+        event = status_c_events.get(code)
+        if event is None:
+            resp.setdefault('unknown', []).append(bytes(data[i:]))
+            break
+        kind, text, evtype, arg = event
+        if kind != CURRENCY:
+            if 'status' in resp:
+                resp['status'].append({'code': code, 'description': text})
+            else:
+                resp['status'] = [{'code': code, 'description': text}]
+            if kind == STATUS:
+                i += arg
+                continue
+            end = i + 2 + (raw[i+1] if i + 1 < n else 0) * 7
+        else:
+            end = i + 8
+        if end > n:
+            resp.setdefault('unknown', []).append(bytes(data[i:]))
+            break
+        events = resp.setdefault(evtype, [])
+        if kind == CURRENCY:
+            value, country = CURRENCY_RECORD.unpack_from(data, i + 1)
+            events.append(CurrencyEvent(arg * value / 100, country, code))
+        else:
+            for value, country in CURRENCY_RECORD.iter_unpack(data[i+2:end]):
+                events.append(CurrencyEvent(arg * value / 100, country, code))
+        i = end
+    return resp
+
 
 class Commands:
     Address_Change = 251
@@ -164,6 +190,154 @@ ADDRESS_CHANGE = 251
 GET_SERIAL = 242
 GET_CATEGORY = 245
 
+IDENTIFY = [
+    Commands.Request_Manufacturer_ID,
+    Commands.Request_Equipment_Category_ID,
+    Commands.Request_Product_Code,
+    Commands.Request_Serial_Number,
+    Commands.Request_Software_Revision
+]
+
+PROBE_TIMEOUT = 0.1
+# devices answer Address_Poll after 4 ms * address, so 255 slots plus margin
+ADDRESS_POLL_WINDOW = 1.2
+
+# devices keep the last five credit/error pairs, more between two polls are lost
+EVENT_BUFFER = 5
+FAST_POLL = 0.1
+SLOW_POLL = 1
+# stay on the fast rate this long after the last event
+FAST_HOLD = 10
+
+BILL_VALIDATOR = b'Bill Validator'
+BILL_TYPES = 16
+# Read_Buffered_Bill_Events result B for a bill type in result A
+BILL_STACKED = 0
+BILL_ESCROW = 1
+# result B when result A is 0
+bill_events = {
+    0: 'Master inhibit active',
+    1: 'Bill returned from escrow',
+    2: 'Invalid bill (validation fail)',
+    3: 'Invalid bill (transport problem)',
+    4: 'Inhibited bill (serial)',
+    5: 'Inhibited bill (DIP switches)',
+    6: 'Bill jammed in transport (unsafe mode)',
+    7: 'Bill jammed in stacker',
+    8: 'Bill pulled backwards',
+    9: 'Bill tamper',
+    10: 'Stacker OK',
+    11: 'Stacker removed',
+    12: 'Stacker inserted',
+    13: 'Stacker faulty',
+    14: 'Stacker full',
+    15: 'Stacker jammed',
+    16: 'Bill jammed in transport (safe mode)',
+    17: 'Opto fraud detected',
+    18: 'String fraud detected',
+    19: 'Anti-string mechanism faulty',
+    20: 'Barcode detected',
+    21: 'Unknown bill type stacked',
+}
+
+
+def buffered_events(last, data):
+    """Return (new, lost, pairs oldest first) for a 229/159 reply.
+
+    The counter runs 1..255 and wraps to 1; 0 means the device was reset.
+    """
+    counter = data[0]
+    if last is None or counter == 0 or counter == last:
+        return 0, 0, []
+    new = (counter - last) % 255 if last else counter
+    pairs = list(splitby(data[1:1 + min(new, EVENT_BUFFER) * 2], 2))
+    pairs.reverse()
+    return new, max(0, new - EVENT_BUFFER), pairs
+
+class Dispatcher:
+    """Per-address command queues on a shared half-duplex bus.
+
+    One frame is on the wire at a time; the next one goes out as soon as the
+    addressed device answers, and replies are matched by source address.
+    """
+    def __init__(self, send, metrics=None):
+        self.send = send
+        self.metrics = metrics
+        self.queues = collections.OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.current = None
+        self.task = None
+
+    def submit(self, adr, cmd, frame, timeout=1):
+        loop = asyncio.get_running_loop()
+        resf = loop.create_future()
+        self.queues.setdefault(adr, collections.deque()).append((cmd, frame, resf, timeout))
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return resf
+
+    def reply(self, adr):
+        if self.current and self.current[0] == adr:
+            _, cmd, resf = self.current
+            self.current = None
+            return cmd, resf
+        return None, None
+
+    def next_job(self):
+        for adr in list(self.queues):
+            queue = self.queues[adr]
+            self.queues.move_to_end(adr)
+            while queue:
+                job = queue.popleft()
+                if not job[2].done():
+                    return adr, job
+            del self.queues[adr]
+        return None, None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            adr, job = self.next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            cmd, frame, resf, timeout = job
+            async with self.lock:
+                if resf.done():
+                    continue
+                self.current = adr, cmd, resf
+                try:
+                    await self.send(frame)
+                except Exception as e:
+                    self.current = None
+                    resf.set_exception(e)
+                    continue
+                start = loop.time()
+                await asyncio.wait([resf], timeout=timeout)
+                if self.current and self.current[2] is resf:
+                    self.current = None
+                if not resf.done():
+                    resf.set_exception(asyncio.TimeoutError())
+                    if self.metrics:
+                        self.metrics.error('timeout')
+                elif self.metrics and not resf.cancelled():
+                    self.metrics.observe(cmd, loop.time() - start)
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        for queue in self.queues.values():
+            for job in queue:
+                job[2].cancel()
+        self.queues.clear()
+        if self.current:
+            self.current[2].cancel()
+            self.current = None
+
+
 async def timeouted(delay, future):
     t = asyncio.get_running_loop().call_later(delay, future.cancel)
     try:
@@ -176,22 +350,30 @@ async def timeouted(delay, future):
 
 
 class CCTalk():
-    def __init__(self,dev,baudrate=9600,adr=2):
+    def __init__(self,dev,baudrate=9600,adr=2,cache=None):
         self.dev = dev
         self.adr = adr
         self.myadr = 1
         self.baudrate = baudrate
         self.opened = asyncio.Future()
-        self.responce = None, None
         self.opened.set_result(False)
         self.eventids = {}
         self.coins = {}
+        self.bills = {}
+        self.credits = {}
         self.device_infos = {}
         self.reader, self.writer, self.read_task = None, None, None
         self.pollers = {}
+        self.events = {}
+        self.accepting = {}
+        self.last_event = {}
+        self.metrics = metrics.register('cctalk', dev, baudrate)
+        self.trace = WireTrace('cctalk:%s' % dev)
+        self.cache = Cache(cache or cache_path('cctalk', dev))
+        self.bus = Dispatcher(self.write, metrics=self.metrics)
 
 
-    async def open(self):
+    async def open(self, retry=True):
         loop = asyncio.get_running_loop()
         self.opened = asyncio.Future()
         if self.read_task and not self.read_task.done():
@@ -210,10 +392,29 @@ class CCTalk():
                 )
             self.read_task = loop.create_task(self.readforever(self.reader,  self.writer, self.opened))
         except Exception as e:
+            if not retry:
+                raise
             logging.error(repr(e))
             logging.error(traceback.format_exc())
             loop.call_later(5, functools.partial(loop.create_task, self.open()))
         return self.opened
+
+    async def disconnect(self):
+        # only the port: event readers and subscribers carry on once it is back
+        if self.read_task and not self.read_task.done():
+            self.read_task.cancel()
+        writer, self.writer = self.writer, None
+        if writer:
+            writer.close()
+
+    async def close(self):
+        for poller in self.pollers.values():
+            poller.cancel()
+        self.pollers.clear()
+        self.bus.close()
+        await self.disconnect()
+        metrics.unregister(self.metrics)
+        self.trace.close()
     
 
     async def status(self, **kw):
@@ -221,22 +422,18 @@ class CCTalk():
 
     async def enable(self, **kw):
         adr = kw.pop('adr', self.adr)
-        # if self.pollers.get(adr):
-        #     self.pollers[adr].cancel()
-        # self.pollers[adr] = loop.create_task(self.poll(adr=adr, **kw))
-        await self.command(Commands.Set_Master_Inhibit_Status, b'\x01', **kw) # master enable
-        await self.command(Commands.Set_Peripheral_Device_Master_Inhibit, b'\x00\x01')
+        await self.command(Commands.Set_Master_Inhibit_Status, b'\x01', adr=adr, **kw) # master enable
+        await self.command(Commands.Set_Peripheral_Device_Master_Inhibit, b'\x00\x01', adr=adr)
+        self.accepting[adr] = True
 
 
     async def disable(self, **kw):
         adr = kw.pop('adr', self.adr)
-        # if self.pollers.get(adr):
-        #     self.pollers[adr].cancel()
-        await self.command(Commands.Set_Master_Inhibit_Status, b'\x00', **kw)
-        await self.command(Commands.Set_Peripheral_Device_Master_Inhibit, b'\x00\x00')
+        self.accepting[adr] = False
+        await self.command(Commands.Set_Master_Inhibit_Status, b'\x00', adr=adr, **kw)
+        await self.command(Commands.Set_Peripheral_Device_Master_Inhibit, b'\x00\x00', adr=adr)
 
     async def init(self, **kw):
-        loop = asyncio.get_running_loop()
         #await self.command(1, adr=adr) # reset
         #await asyncio.sleep(5)
         if kw.get('adr'):
@@ -244,45 +441,18 @@ class CCTalk():
         elif kw.get('adrs'):
             ar = kw.pop('adrs')
         else:
-            ar = range(1,256)
-            
+            ar = await self.discover()
+
+        answered = []
         for adr in ar:
             try:
                 await self.command(Commands.Simple_Poll, adr=adr, **kw)
             except:
                 continue
-        
 
+            await self.identify(adr, **kw)
+            answered.append(adr)
 
-            self.device_infos.setdefault(adr,{})
-            for cmd in [
-                    Commands.Request_Manufacturer_ID,
-                    Commands.Request_Equipment_Category_ID,
-                    Commands.Request_Product_Code,
-                    Commands.Request_Serial_Number,
-                    Commands.Request_Software_Revision
-                ]:
-                try:
-                    data = await self.command(cmd, adr=adr, **kw)
-                except:
-                    continue
-                self.device_infos[data['adr']][cmd] = data
-
-
-            if self.device_infos[adr][245]['raw'] == b'SMART_HOPPER': 
-                dr = await self.command(46, adr=adr)
-                d = dr.get('raw')
-                count , d = d[0], d[1:]
-                for i in range(count):
-                    n = d[7*i:7*i+7]
-                    r = int.from_bytes(n[:-3],'little')/100
-                    b = {
-                        'denomination': r,
-                        'country': n[-3:].decode()
-                    }
-                    self.coins.setdefault(adr, {})
-                    self.coins[adr][i] = b
-                    
             # if False:      
             #     await self.command(231, b'\xff\xff', adr=adr, **kw) # coins enable
 
@@ -306,85 +476,292 @@ class CCTalk():
             #         self.coins.setdefault(adr,{})
             #         self.coins[adr][i]=b
             #     logging.debug(self.coins)
+        return answered
 
+    def preload(self):
+        for adr, entry in self.cache.latest('adr').items():
+            self.restore(entry)
+
+    def restore(self, entry):
+        adr = entry['adr']
+        self.device_infos[adr] = {
+            int(cmd): {'adr': adr, 'raw': bytes.fromhex(raw), 'cmd': int(cmd)}
+            for cmd, raw in entry['infos'].items()
+        }
+        if entry.get('coins'):
+            self.coins[adr] = {int(i): coin for i, coin in entry['coins'].items()}
+        if entry.get('bills'):
+            self.bills[adr] = {int(i): bill for i, bill in entry['bills'].items()}
+
+    async def identify(self, adr, **kw):
+        # serial number and software revision are enough to trust the cached descriptors
+        try:
+            serial = await self.command(Commands.Request_Serial_Number, adr=adr, **kw)
+            software = await self.command(Commands.Request_Software_Revision, adr=adr, **kw)
+        except:
+            return await self.refresh(adr, **kw)
+        key = '%s:%s' % (serial['raw'].hex(), software['raw'].hex())
+        entry = self.cache.get(key)
+        if not entry or entry.get('adr') != adr:
+            return await self.refresh(adr, **kw)
+        self.restore(entry)
+        if self.cache.stale(key):
+            asyncio.get_running_loop().create_task(self.refresh(adr, **kw))
+        return self.device_infos[adr]
+
+    async def refresh(self, adr, **kw):
+        infos = {}
+        for cmd in IDENTIFY:
+            try:
+                infos[cmd] = await self.command(cmd, adr=adr, **kw)
+            except:
+                continue
+        self.device_infos[adr] = infos
+        if infos.get(GET_CATEGORY, {}).get('raw') == b'SMART_HOPPER':
+            self.coins[adr] = await self.read_coins(adr)
+        elif infos.get(GET_CATEGORY, {}).get('raw') == BILL_VALIDATOR:
+            self.bills[adr] = await self.read_bills(adr)
+        if Commands.Request_Serial_Number in infos and Commands.Request_Software_Revision in infos:
+            serial = infos[Commands.Request_Serial_Number]['raw'].hex()
+            key = '%s:%s' % (serial, infos[Commands.Request_Software_Revision]['raw'].hex())
+            self.cache.set(key, {
+                'adr': adr,
+                'serial': serial,
+                'infos': {str(cmd): data['raw'].hex() for cmd, data in infos.items()},
+                'coins': self.coins.get(adr, {}),
+                'bills': self.bills.get(adr, {}),
+            })
+        return infos
+
+    async def read_coins(self, adr):
+        coins = {}
+        dr = await self.command(Commands.Get_Device_Setup_c, adr=adr)
+        d = dr.get('raw')
+        count , d = d[0], d[1:]
+        for i in range(count):
+            n = d[7*i:7*i+7]
+            r = int.from_bytes(n[:-3],'little')/100
+            coins[i] = {
+                'denomination': r,
+                'country': n[-3:].decode()
+            }
+        return coins
+
+    async def read_bills(self, adr):
+        # bill id is country, value and issue, e.g. RU0100A, scaled per country
+        bills = {}
+        scaling = {}
+        for i in range(1, BILL_TYPES + 1):
+            try:
+                raw = (await self.command(Commands.Request_Bill_id, bytes([i]), adr=adr))['raw']
+                country, value = raw[:2], int(raw[2:6])
+                if country not in scaling:
+                    factor = (await self.command(Commands.Request_Country_Scaling_Factor, country, adr=adr))['raw']
+                    scaling[country] = int.from_bytes(factor[:2], 'little') / 10 ** factor[2]
+            except (asyncio.TimeoutError, ValueError, IndexError):
+                continue
+            bills[i] = {
+                'denomination': value * scaling[country],
+                'country': country.decode(),
+            }
+        return bills
+
+    async def probe(self, adr, cmd=Commands.Simple_Poll):
+        try:
+            return await self.command(cmd, adr=adr, timeout=PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+
+    async def address_poll(self, window=ADDRESS_POLL_WINDOW):
+        # replies are bare address bytes, not frames, so the frame reader is paused
+        loop = asyncio.get_running_loop()
+        async with self.bus.lock:
+            if self.read_task and not self.read_task.done():
+                self.read_task.cancel()
+                try:
+                    await self.read_task
+                except (asyncio.CancelledError, Exception):
+                    pass
+            payload = checksum(bytes([0, 0, self.myadr, Commands.Address_Poll, 0]))
+            raw = b''
+            try:
+                await self.write(payload)
+                deadline = loop.time() + window
+                while True:
+                    remain = deadline - loop.time()
+                    if remain <= 0:
+                        break
+                    try:
+                        raw += await asyncio.wait_for(self.reader.read(256), remain)
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                self.read_task = loop.create_task(self.readforever(self.reader, self.writer, asyncio.Future()))
+        self.trace.rx(raw)
+        if raw.startswith(payload):
+            raw = raw[len(payload):]
+        return sorted(set(raw) - {0, self.myadr})
+
+    async def discover(self):
+        latest = self.cache.latest('adr')
+        cached = sorted(latest)
+        found = []
+        for adr in cached:
+            serial = await self.probe(adr, Commands.Request_Serial_Number)
+            if serial and latest[adr].get('serial') == serial['raw'].hex():
+                found.append(adr)
+        if cached and found == cached:
+            logging.info('cctalk devices from cache: %s', found)
+            return found
+        found = await self.address_poll()
+        if not found:
+            found = [adr for adr in range(1, 256) if adr != self.myadr and await self.probe(adr)]
+        logging.info('cctalk devices found: %s', found)
+        return found
 
     async def poll(self, **kw):
         while True:
             await asyncio.sleep(2)
             await self.status(**kw)
 
-    async def waitf(self, timeout):
-        old_cmd, old_resf = self.responce
-        if old_resf and not old_resf.done():
-            await asyncio.wait_for(old_resf, timeout=timeout)
-    
     async def command(self, cmd, data=b'', adr=None, timeout=1):
         if adr is None:
             adr = self.adr
         payload = bytes([adr, len(data), self.myadr, cmd])+data+b'\x00'
         payload = checksum(payload)
-        resf = asyncio.Future()
-
-        await self.waitf(timeout)
+        return await self.bus.submit(adr, cmd, payload, timeout)
 
-        self.responce = cmd, resf
-        await self.write(payload)
-
-        return await asyncio.wait_for(resf, timeout=timeout)
+    async def poll_all(self, cmd=Commands.Simple_Poll, adrs=None, timeout=1):
+        # every device gets its frame in the same tick, back to back on the wire
+        adrs = sorted(self.device_infos) if adrs is None else adrs
+        results = await asyncio.gather(*[
+            self.command(cmd, adr=adr, timeout=timeout) for adr in adrs
+        ], return_exceptions=True)
+        return dict(zip(adrs, results))
 
 
     async def write(self, data):
         await asyncio.sleep(0)
-        logging.debug('< %s',data.hex())
+        self.trace.tx(data)
+        if debug():
+            logging.debug('< %s',data.hex())
         self.writer.write(data)
-        await self.writer.drain()  
-
-    async def on_event(self, adr, evdata):
-        denomination = self.coins[adr].get(evdata[0],{})
-        denomination['raw'] = evdata
-        return denomination
+        if self.metrics:
+            self.metrics.tx(len(data))
+        await self.writer.drain()
+
+    def on_event(self, adr, evdata):
+        # result A is the channel (1 based) or 0 with an error code in result B
+        channel, code = evdata
+        event = {'adr': adr, 'channel': channel, 'code': code, 'raw': evdata}
+        if channel:
+            coin = self.coins.get(adr, {}).get(channel - 1)
+            event['credit'] = [dict(coin) if coin else None]
+        else:
+            event['error'] = code
+        return event
+
+    def on_bill_event(self, adr, evdata):
+        # result A is the bill type, B says stacked or held in escrow; A 0 carries a status in B
+        bill_type, code = evdata
+        event = {'adr': adr, 'channel': bill_type, 'code': code, 'raw': evdata}
+        if bill_type:
+            bill = self.bills.get(adr, {}).get(bill_type)
+            if code == BILL_STACKED:
+                event['credit'] = [dict(bill) if bill else None]
+            elif code == BILL_ESCROW:
+                event['escrow'] = [dict(bill) if bill else None]
+            else:
+                event['error'] = code
+        else:
+            event['error'] = code
+            event['description'] = bill_events.get(code, 'Unknown')
+        return event
+
+    def subscribe(self, adr=None, maxsize=0):
+        adr = adr or self.adr
+        hub = self.events.setdefault(adr, Broadcast())
+        if adr not in self.pollers or self.pollers[adr].done():
+            self.pollers[adr] = asyncio.get_running_loop().create_task(self.event_reader(adr))
+        return hub.subscribe(maxsize)
+
+    def poll_interval(self, adr):
+        loop = asyncio.get_running_loop()
+        if self.accepting.get(adr) or loop.time() - self.last_event.get(adr, -FAST_HOLD) < FAST_HOLD:
+            return FAST_POLL
+        return SLOW_POLL
 
+    async def event_reader(self, adr):
+        loop = asyncio.get_running_loop()
+        hub = self.events[adr]
+        category = self.device_infos.get(adr, {}).get(GET_CATEGORY, {}).get('raw')
+        cmd = Commands.Read_Buffered_Bill_Events if category == BILL_VALIDATOR else 229
+        failing = False
+        while True:
+            start = loop.time()
+            try:
+                resp = await self.command(cmd, adr=adr)
+                failing = False
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not failing:
+                    error = 'timeout'
+                    if not isinstance(e, asyncio.TimeoutError):
+                        logging.error('cctalk %d event reader: %r', adr, e)
+                        error = repr(e)
+                    hub.publish({'adr': adr, 'error': error, 'fault': True})
+                failing = True
+                await asyncio.sleep(SLOW_POLL)
+                continue
+            if resp.get('lost'):
+                logging.warning('cctalk %d lost %d buffered events', adr, resp['lost'])
+                hub.publish({'adr': adr, 'lost': resp['lost'], 'fault': True})
+            for event in resp.get('events', []):
+                self.last_event[adr] = loop.time()
+                hub.publish(event)
+                if event.get('credit') and adr in self.credits:
+                    self.credits[adr].publish(event)
+            await asyncio.sleep(max(0, start + self.poll_interval(adr) - loop.time()))
 
     async def stack_one(self,**kw):
-        while True:
-            await asyncio.sleep(0.5)
-            print('!')
-            out = await self.status(**kw)
-            if out.get('credit'):
-                return out
-            
+        adr = kw.pop('adr', self.adr)
+        # every credit goes to one caller, concurrent callers wait for their own
+        credits = self.credits.setdefault(adr, Claims())
+        with self.subscribe(adr, maxsize=1):
+            return await credits.claim()
 
     def parse_status_c(self, resp):
-        data = resp['raw']
-        i = 0
-        while i < len(data):
-            code = data[i]
-            b, resp =  status_c_parsers[code](resp, data[i:])
-            i += b
+        resp = parse_status_c(resp)
+        if 'unknown' in resp:
+            logging.warning('unknown status event %s', resp['unknown'])
         return resp
 
 
-    async def on_reply(self, adr, data):
-        cmd, resf = self.responce
+    def on_reply(self, adr, data):
+        cmd, resf = self.bus.reply(adr)
+        if resf is None or resf.done():
+            if self.metrics:
+                self.metrics.error('unexpected')
+            if debug():
+                logging.debug('unexpected reply from %d: %s', adr, data.hex())
+            return
         resp = {
             'adr': adr, 'raw': data, 'cmd': cmd
         }
-        logging.debug('>>'+str(resp))
+        if debug():
+            logging.debug('>> %s', resp)
         if cmd == Commands.Request_Status_c:
             resp = self.parse_status_c(resp)
-        elif cmd == 229:
-            newcount = data[0] - self.eventids.get(adr, 0)
+        elif cmd in [Commands.Read_Buffered_Bill_Events, 229] and data:
+            new, lost, pairs = buffered_events(self.eventids.get(adr), data)
             self.eventids[adr] = data[0]
-            if newcount < 0:
-                newcount = newcount % 256 - 1
-            logging.debug(newcount)
-            events = splitby(data[1:1+newcount*2],2)
-
-            resp['events'] = []
-            for evdata in events:
-                resp['events'].append(
-                    await self.on_event(adr, evdata)
-                )
+            resp['counter'] = data[0]
+            resp['lost'] = lost
+            on_event = self.on_bill_event if cmd == Commands.Read_Buffered_Bill_Events else self.on_event
+            resp['events'] = [on_event(adr, evdata) for evdata in pairs]
+            if lost and self.metrics:
+                self.metrics.error('lost_events', lost)
 
         resf.set_result(resp)
 
@@ -399,6 +776,9 @@ class CCTalk():
                 crc = await reader.readexactly(1)
                 #print([to,lng,fro,head,*data,*crc])
                 raw = bytes([to,lng,fro,head,*data,*crc])
+                self.trace.rx(raw)
+                if self.metrics:
+                    self.metrics.rx(len(raw))
 
                 if to != self.myadr:
                     continue
@@ -408,18 +788,29 @@ class CCTalk():
                 elif raw == checksum(bytes([to,lng,0,head,*data,0]), useccitt=True) :
                     adr = 0
                 else:
+                    if self.metrics:
+                        self.metrics.error('checksum')
+                    self.trace.dump('bad checksum', level=logging.WARNING)
                     continue
 
+                if head == 5 and self.metrics: # NAK
+                    self.metrics.error('nak')
+
                 if lng == 0 and head == 0: # ACK
                     pass
 
-                logging.debug('> %s', raw.hex())
-                loop.create_task(self.on_reply(adr, data))
+                if debug():
+                    logging.debug('> %s', raw.hex())
+                try:
+                    self.on_reply(adr, data)
+                except Exception as e:
+                    logging.exception(e)
 
 
         except serial.SerialException as e:
             logging.error(repr(e))
             logging.error(traceback.format_exc())
+            self.trace.dump('serial error')
             loop = asyncio.get_running_loop()
             loop.create_task(self.open())
             raise e
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from . import protocol
+from .bench import STATUS_PAYLOADS, legacy_parse_status_c
+
+
+@pytest.mark.parametrize('name', list(STATUS_PAYLOADS))
+def test_parse_status_c(name):
+    # struct parser against the closure parser it replaced
+    raw = STATUS_PAYLOADS[name]
+    old = legacy_parse_status_c({'raw': raw})
+    new = protocol.parse_status_c({'raw': raw})
+    assert old.get('status') == new.get('status')
+    for evtype in ['credit', 'processing']:
+        a = sorted((e['denomination'], e['country'], e['code']) for e in old.get(evtype, []))
+        b = sorted((e.denomination, e.country, e.code) for e in new.get(evtype, []))
+        assert a == b
+
+
+def test_parse_status_c_truncated():
+    resp = protocol.parse_status_c({'raw': b'\x0d\xe8\x03'})
+    assert resp['unknown'] == [b'\x0d\xe8\x03']
+
+
+def test_event_reader_survives_errors(monkeypatch, tmp_path):
+    monkeypatch.setattr(protocol, 'SLOW_POLL', 0)
+    replies = [ValueError('garbled'), ValueError('garbled'), {'events': [{'credit': 1}]}]
+
+    async def command(cmd, adr=None):
+        reply = replies.pop(0) if replies else {}
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    async def run():
+        ct = protocol.CCTalk('/dev/null', cache=str(tmp_path / 'cache'))
+        ct.command = command
+        try:
+            with ct.subscribe() as events:
+                # the fault is published once, polling carries on after it
+                fault = await asyncio.wait_for(events.get(), 1)
+                event = await asyncio.wait_for(events.get(), 1)
+                assert not ct.pollers[ct.adr].done()
+        finally:
+            await ct.close()
+        return fault, event
+
+    fault, event = asyncio.run(run())
+    assert fault == {'adr': 2, 'error': "ValueError('garbled')", 'fault': True}
+    assert event == {'credit': 1}
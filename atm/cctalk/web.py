@@ -0,0 +1,115 @@
+from aiohttp import web
+from . import protocol
+from ..web import dumps, HTTPUnreachable
+import logging
+import asyncio
+import json
+
+
+INIT_RETRY = 5
+
+
+def check_ready(request):
+    init = request.app.cctalk_init
+    if not init['ready']:
+        raise web.HTTPServiceUnavailable(content_type="application/json", text=dumps(init))
+    return request.app.cctalk
+
+
+async def health(request):
+    init = request.app.cctalk_init
+    return web.json_response(init, dumps=dumps, status=200 if init['ready'] else 503)
+
+async def status(request):
+    ct = check_ready(request)
+    try:
+        data = await ct.status()
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        raise HTTPUnreachable(content_type="application/json", text=json.dumps({"error": repr(e)}))
+    return web.json_response(data, dumps=dumps)
+
+async def enable(request):
+    ct = check_ready(request)
+    try:
+        await ct.enable()
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        raise HTTPUnreachable(content_type="application/json", text=json.dumps({"error": repr(e)}))
+    return web.json_response({'ok': True})
+
+async def disable(request):
+    ct = check_ready(request)
+    try:
+        await ct.disable()
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        raise HTTPUnreachable(content_type="application/json", text=json.dumps({"error": repr(e)}))
+    return web.json_response({'ok': True})
+
+async def coins(request):
+    return web.json_response(request.app.cctalk.coins, dumps=dumps)
+
+async def get_coin(request):
+    ct = check_ready(request)
+    try:
+        data = await asyncio.wait_for(ct.stack_one(), 30)
+    except Exception as e:
+        data = {'error': str(e)}
+    return web.json_response(data, dumps=dumps)
+
+async def initialize(app, scan=False):
+    init = app.cctalk_init
+    ct = app.cctalk
+    while not init['ready']:
+        try:
+            init['stage'] = 'connecting'
+            await (await ct.open(retry=False))
+            init['stage'] = 'identification'
+            if scan:
+                answered = await ct.init()
+                if answered and ct.adr not in answered:
+                    ct.adr = min(answered)
+            else:
+                answered = await ct.init(adr=ct.adr)
+            if ct.adr not in answered:
+                raise asyncio.TimeoutError('no answer from %d' % ct.adr)
+            logging.info(ct.coins)
+            init['devices'] = answered
+            init['error'] = None
+            init['stage'] = 'ready'
+            init['ready'] = True
+        except asyncio.CancelledError:
+            if init['stage'] == 'stopped':
+                raise
+            init['error'] = 'timeout at %s' % init['stage']
+        except Exception as e:
+            logging.error(repr(e))
+            init['error'] = repr(e)
+        init['elapsed'] = asyncio.get_running_loop().time() - init['started']
+        if not init['ready']:
+            logging.error('cctalk init failed: %s', init['error'])
+            await ct.disconnect()
+            await asyncio.sleep(INIT_RETRY)
+
+async def shutdown(app):
+    app.cctalk_init['stage'] = 'stopped'
+    app.cctalk_init_task.cancel()
+    await app.cctalk.close()
+
+async def setup(app, config):
+    port = config.get('com')
+    assert port, "No port in config"
+    app.cctalk = protocol.CCTalk(port, adr=config.get('adr', 2), baudrate=config.get('baudrate', 9600))
+    app.cctalk.preload()
+    app.cctalk_init = {
+        'ready': False,
+        'stage': 'starting',
+        'error': None,
+        'started': asyncio.get_running_loop().time()
+    }
+    app.cctalk_init_task = asyncio.get_running_loop().create_task(initialize(app, config.get('scan')))
+    app.on_cleanup.append(shutdown)
+    app.router.add_get('/atm/cctalk/health', health)
+    app.router.add_post('/atm/cctalk/status', status)
+    app.router.add_post('/atm/cctalk/enable', enable)
+    app.router.add_post('/atm/cctalk/disable', disable)
+    app.router.add_post('/atm/cctalk/coins', coins)
+    app.router.add_post('/atm/cctalk/get_coin', get_coin)
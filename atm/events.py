@@ -0,0 +1,73 @@
+import asyncio
+
+
+class Subscription:
+    def __init__(self, hub, maxsize=0):
+        self.hub = hub
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        # a slow consumer loses its oldest events instead of stalling the publisher
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.hub.subscribers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class Broadcast:
+    def __init__(self):
+        self.subscribers = set()
+
+    def subscribe(self, maxsize=0):
+        sub = Subscription(self, maxsize)
+        self.subscribers.add(sub)
+        return sub
+
+    def publish(self, event):
+        for sub in list(self.subscribers):
+            sub.put(event)
+
+    def __len__(self):
+        return len(self.subscribers)
+
+
+class Claims:
+    """Events that go to exactly one waiter, such as credits.
+
+    Only kept while somebody waits, so a credit nobody asked for is not
+    handed to the next caller.
+    """
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.waiting = 0
+
+    def publish(self, event):
+        if self.waiting:
+            self.queue.put_nowait(event)
+        return bool(self.waiting)
+
+    async def claim(self):
+        self.waiting += 1
+        try:
+            return await self.queue.get()
+        finally:
+            self.waiting -= 1
@@ -0,0 +1,38 @@
+import asyncio
+import sys
+
+from . import protocol, emulator
+from ..bench import measure, report
+from ..emulator import nodelay
+
+
+async def bench_bus(count=50, delay=0):
+    server, device, url = await emulator.serve(emulator.Dispenser(upper=10000, lower=10000), delay=delay)
+    lcdm = protocol.LCDM(url, upper_nominal=1000, lower_nominal=100)
+    await (await lcdm.open())
+    nodelay(lcdm.writer.transport)
+    results = {}
+    results['status'] = await measure(lcdm.status, count)
+    results['dispense 1 note'] = await measure(lambda: lcdm.dispense(100), max(1, count // 5))
+    async def two_cassettes():
+        # few small notes left, so the planner has to mix both cassettes
+        await lcdm.load(10000, 20)
+        return await lcdm.dispense(3500)
+    results['dispense 2 cassettes'] = await measure(two_cassettes, max(1, count // 5))
+    results['plan 4 cassettes'] = await measure(lambda: asyncio.sleep(0, protocol.plan(299900, [100, 500, 1000, 5000], [2000] * 4)), 10)
+    results['cycles'] = device.cycles
+    await lcdm.close()
+    server.close()
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    results = asyncio.run(bench_bus(count))
+    print('mechanical cycles: %d' % results.pop('cycles'))
+    for title, result in results.items():
+        report('emulator %s' % title, *result)
+
+
+if __name__ == "__main__":
+    main()
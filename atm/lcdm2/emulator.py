@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import random
+import sys
+from operator import xor
+from functools import reduce
+
+from .protocol import (
+    SOH, STX, ETX, EOT, ACK, NCK, ID, PRURGE, UPPER_DISPENSE, STATUS, ROMVERSION,
+    LOWER_DISPENSE, UPPER_LOWER_DISPENSE, TEST_UPPER_DISPENSE, TEST_LOWER_DISPENSE
+)
+from ..emulator import listen
+
+GOOD = 0x30
+NORMAL_STOP = 0x31
+UPPER_END = 0x38
+LOWER_END = 0x40
+UNDEFINED = 0x37
+
+
+class Dispenser:
+    def __init__(self, upper=100, lower=100, cycle=0.05, note_time=0.01, reject_rate=0, seed=None, combined=True):
+        self.counts = {UPPER_DISPENSE: upper, LOWER_DISPENSE: lower}
+        self.cycle = cycle
+        self.note_time = note_time
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.sensors = 128 | 512 | 1024
+        self.cycles = 0
+        self.combined = combined
+
+    def pick(self, cmd, count, test=False):
+        available = self.counts[cmd]
+        picked = min(count, available)
+        rejects = sum(1 for i in range(picked) if self.random.random() < self.reject_rate)
+        exited = picked - rejects
+        if not test:
+            self.counts[cmd] = available - picked
+        if picked < count:
+            error = UPPER_END if cmd == UPPER_DISPENSE else LOWER_END
+        else:
+            error = GOOD
+        return picked, exited, rejects, error
+
+    def dispense(self, cmd, param, test=False):
+        count = int(param[:2])
+        picked, exited, rejects, error = self.pick(cmd, count, test)
+        data = b'%02d%02d' % (picked, exited) + bytes([NORMAL_STOP, error]) + b'%02d' % rejects
+        return data, self.cycle + self.note_time * picked
+
+    def dispense_both(self, param):
+        upper = self.pick(UPPER_DISPENSE, int(param[:2]))
+        lower = self.pick(LOWER_DISPENSE, int(param[2:4]))
+        error = upper[3] if upper[3] != GOOD else lower[3]
+        data = (b'%02d%02d%02d%02d' % (upper[0], upper[1], lower[0], lower[1]) +
+                bytes([error, NORMAL_STOP]) + b'%02d%02d' % (upper[2], lower[2]))
+        return data, self.cycle + self.note_time * (upper[0] + lower[0])
+
+    def on_command(self, cmd, param):
+        if cmd in [UPPER_DISPENSE, LOWER_DISPENSE]:
+            self.cycles += 1
+            return self.dispense(cmd, param)
+        elif cmd == UPPER_LOWER_DISPENSE and self.combined:
+            self.cycles += 1
+            return self.dispense_both(param)
+        elif cmd in [TEST_UPPER_DISPENSE, TEST_LOWER_DISPENSE]:
+            self.cycles += 1
+            return self.dispense(UPPER_DISPENSE if cmd == TEST_UPPER_DISPENSE else LOWER_DISPENSE, param, test=True)
+        elif cmd == STATUS:
+            return b'0' + bytes([GOOD]) + self.sensors.to_bytes(2, 'little'), 0
+        elif cmd == ROMVERSION:
+            return b'V1.0', 0
+        elif cmd == PRURGE:
+            return b'0' + bytes([GOOD]), self.cycle
+        return b'0' + bytes([UNDEFINED]), 0
+
+
+class LCDMLink(asyncio.Protocol):
+    def __init__(self, device, delay=0.002, nck_every=0, repeat=False):
+        self.device = device
+        self.delay = delay
+        # line glitches: NCK every n-th good frame, send every answer twice
+        self.nck_every = nck_every
+        self.repeat = repeat
+        self.frames = 0
+        self.buf = bytearray()
+        self.transport = None
+        self.acks = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        if self.transport and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def data_received(self, data):
+        buf = self.buf
+        buf += data
+        while buf:
+            if buf[0] in [ACK, NCK]:
+                self.acks += 1
+                del buf[:1]
+            elif buf[0] == EOT:
+                end = buf.find(bytes([ETX]))
+                if end < 0 or len(buf) < end + 2:
+                    return
+                frame = bytes(buf[:end+2])
+                del buf[:end+2]
+                self.on_frame(frame)
+            else:
+                del buf[:1]
+
+    def on_frame(self, frame):
+        self.frames += 1
+        if reduce(xor, frame[:-1]) != frame[-1] or (self.nck_every and self.frames % self.nck_every == 0):
+            self.write(bytes([NCK]))
+            return
+        self.write(bytes([ACK]))
+        cmd, param = frame[3], frame[4:-2]
+        data, busy = self.device.on_command(cmd, param)
+        resp = bytes([SOH, ID, STX, cmd]) + data + bytes([ETX])
+        resp += bytes([reduce(xor, resp)])
+        asyncio.get_running_loop().call_later(self.delay + busy, self.write, resp)
+        if self.repeat:
+            asyncio.get_running_loop().call_later(self.delay + busy, self.write, resp)
+
+
+async def serve(device=None, host='127.0.0.1', port=0, **kw):
+    device = device or Dispenser()
+    server, url = await listen(lambda: LCDMLink(device, **kw), host, port)
+    return server, device, url
+
+
+async def main():
+    server, device, url = await serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print(url)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -5,6 +5,9 @@ from functools import reduce
 import time
 import logging
 import struct
+import collections
+from .. import metrics
+from ..trace import WireTrace, debug
 
 SOH = 0x01
 STX = 0x02
@@ -55,28 +58,143 @@ ERRORS = {
 }
 
 
+# cassette order follows self.nominals: lower first, then upper
+DISPENSE_COMMANDS = [LOWER_DISPENSE, UPPER_DISPENSE]
+# "bill end" errors tell which cassette ran out
+END_ERRORS = {0x40: 0, 0x38: 1}
+CONTINUE_ERRORS = [0, 0x30, 0x31, 0x38, 0x40]
+# no answer or an unreadable one: notes may have left, never retry the payout
+UNKNOWN_OUTCOME = -1
+# NCKed every time or a short refusal: the unit did not start the command
+NOT_ACCEPTED = -2
+# combined dispense refused: use single cassette commands from now on
+SPLIT_ERRORS = [NOT_ACCEPTED, 0x37]
+
+# most notes one dispense command moves
+MAX_CYCLE = 60
+# upper bound on notes per payout, keeps the planner search bounded
+MAX_PAYOUT = 1000
+
+
+def cycles(count, cycle=MAX_CYCLE):
+    return -(-count // cycle)
+
+
+def plan(amount, nominals, counters=None, cycle=MAX_CYCLE, limit=MAX_PAYOUT, combined=False):
+    """Notes to take from every cassette to pay amount exactly, or None.
+
+    Minimizes dispense cycles, then the number of notes. Counters of None
+    mean the cassette content is unknown and is not limited. With combined
+    all cassettes feed the same cycle, so the longest one counts.
+    """
+    counters = counters or [None] * len(nominals)
+    usable = [
+        (i, nominal, limit if count is None else min(count, limit))
+        for i, (nominal, count) in enumerate(zip(nominals, counters)) if nominal
+    ]
+    usable.sort(key=lambda c: -c[1])
+    # remaining amount -> (cycles, notes, counts), one cassette at a time
+    states = {amount: (0, 0, ())}
+    for depth, (i, nominal, available) in enumerate(usable):
+        last = depth == len(usable) - 1
+        nxt = {}
+        for rest, (cost, notes, counts) in states.items():
+            top = min(available, rest // nominal, limit - notes)
+            if last:
+                options = [rest // nominal] if rest % nominal == 0 and rest // nominal <= top else []
+            else:
+                options = range(top, -1, -1)
+            for n in options:
+                left = rest - n * nominal
+                cost_n = max(cost, cycles(n, cycle)) if combined else cost + cycles(n, cycle)
+                candidate = (cost_n, notes + n, counts + ((i, n),))
+                if left not in nxt or candidate[:2] < nxt[left][:2]:
+                    nxt[left] = candidate
+        states = nxt
+    best = states.get(0)
+    if best is None:
+        return None
+    out = [0] * len(nominals)
+    for i, n in best[2]:
+        out[i] = n
+    return out
+
+# link layer: the unit ACKs a command at once and answers when the cycle is over
+ACK_TIMEOUT = 2
+RESPONSE_TIMEOUT = 5
+DISPENSE_TIMEOUT = 60
+RETRIES = 3
+RECONNECT_DELAY = 10
+# commands that move notes are never sent twice unless the unit NCKed them
+SAFE_COMMANDS = [STATUS, ROMVERSION]
+
+
+SENSORS = [
+    'chk1', 'chk2', 'div1', 'div2', 'ejt', 'exit', 'nearend0', 'always1',
+    'sol', 'cassette0', 'cassette1', 'chk3', 'chk4', 'nearend1', 'reject', 'unused'
+]
+SENSOR_HISTORY = 256
+
+
+class Sensors:
+    """Sensor byte pair from STATUS kept as one int, bits named as in SENSORS."""
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(int.from_bytes(data, 'little'))
+
+    def __getitem__(self, name):
+        return bool(self.bits >> SENSORS.index(name) & 1)
+
+    def __eq__(self, other):
+        return isinstance(other, Sensors) and self.bits == other.bits
+
+    def __hash__(self):
+        return self.bits
+
+    def __int__(self):
+        return self.bits
+
+    def __repr__(self):
+        return 'Sensors(0x%04x)' % self.bits
+
+    def changed(self, other=None):
+        """Sensors whose state differs from other, with their new state."""
+        diff = self.bits ^ (other.bits if other is not None else ~self.bits)
+        return {name: bool(self.bits >> i & 1) for i, name in enumerate(SENSORS) if diff >> i & 1}
+
+    def _asdict(self):
+        return {name: bool(self.bits >> i & 1) for i, name in enumerate(SENSORS)}
+
+
+for _i, _name in enumerate(SENSORS):
+    setattr(Sensors, _name, property(lambda self, _i=_i: bool(self.bits >> _i & 1)))
+
+
+class SensorHistory:
+    """Fixed size ring of (time, bits) snapshots."""
+    def __init__(self, size=SENSOR_HISTORY):
+        self.snapshots = collections.deque(maxlen=size)
+
+    def append(self, sensors, when=None):
+        self.snapshots.append((time.time() if when is None else when, sensors.bits))
+
+    def last(self):
+        return Sensors(self.snapshots[-1][1]) if self.snapshots else None
+
+    def as_list(self):
+        return list(self.snapshots)
+
+    def __len__(self):
+        return len(self.snapshots)
+
 
 def sensors_parse(data):
-    d = int.from_bytes(data,'little')
-
-    return {
-        'chk1': bool(d & 1),
-        'chk2': bool(d & 2),
-        'div1': bool(d & 4),
-        'div2': bool(d & 8),
-        'ejt': bool(d & 16),
-        'exit': bool(d & 32),
-        'nearend0' : bool(d & 64),
-        'always1': bool(d & 128),
-        'sol': bool(d & 256),
-        'cassette0': bool(d & 512),
-        'cassette1': bool(d & 1024),
-        'chk3': bool(d & 2048),
-        'chk4': bool(d & 4096),
-        'nearend1': bool(d & 8192),
-        'reject': bool(d & 16384),
-        'unused': bool(d & 32768)
-    }    
+    return Sensors.from_bytes(data)._asdict()
 
 
 async def timeouted(delay, future):
@@ -88,101 +206,244 @@ async def timeouted(delay, future):
     finally:
         t.cancel()
 
+class NotAccepted(asyncio.TimeoutError):
+    """The unit NCKed every try, so the command never ran."""
+
+
 def command(cmd, data=b''):
     CMD = bytes([EOT,ID,STX,cmd,*list(data),ETX])
     CMD += bytes([reduce(xor, CMD)])
-    print(CMD)
     return CMD
 
 import serial_asyncio
 
 class LCDM():
-    def __init__(self, dev=None, upper_nominal=0, lower_nominal=0):
+    def __init__(self, dev=None, upper_nominal=0, lower_nominal=0, combined=True):
         self.dev = dev
         self.nominals = [lower_nominal, upper_nominal]
-        self.ask = asyncio.Future()
-        self.ask.set_exception(Exception('Open first'))
+        self.counters = [None, None]
+        self.combined = combined
+        self.ask = None
         self.responces = {}
+        self.reader, self.writer = None, None
         self.read_task = None
+        self.reconnecting = None
+        self.sensor_history = SensorHistory()
+        self.last_sensors = None
+        self.lock = asyncio.Lock()
+        self.metrics = metrics.register('lcdm2', dev, 19200)
+        self.trace = WireTrace('lcdm2:%s' % dev)
 
     async def open(self):
-        self.ask = asyncio.Future()
+        opened = asyncio.get_running_loop().create_future()
         try:
             self.reader, self.writer = await serial_asyncio.open_serial_connection(url=self.dev, baudrate=19200, timeout=5, rtscts=0, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE )
             self.read_task = asyncio.get_running_loop().create_task(self.readforever(self.reader,  self.writer))
-            self.ask.set_result(None)
+            opened.set_result(True)
         except Exception as e:
             logging.error(repr(e))
-            loop = asyncio.get_running_loop()
-            loop.call_later(10, loop.create_task(self.open()))
-        return self.ask
+            self.reconnect()
+            opened.set_result(False)
+        return opened
+
+    async def close(self):
+        for task in [self.reconnecting, self.read_task]:
+            if task and not task.done():
+                task.cancel()
+        writer, self.writer = self.writer, None
+        if writer:
+            writer.close()
+        metrics.unregister(self.metrics)
+        self.trace.close()
+
+    def reconnect(self):
+        if self.reconnecting is None or self.reconnecting.done():
+            self.reconnecting = asyncio.get_running_loop().create_task(self.reconnector())
+
+    async def reconnector(self):
+        # runs beside the caller; commands fail fast until the port is back
+        while True:
+            await asyncio.sleep(RECONNECT_DELAY)
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+            try:
+                self.reader, self.writer = await serial_asyncio.open_serial_connection(url=self.dev, baudrate=19200, timeout=5, rtscts=0, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE )
+            except Exception as e:
+                logging.error('lcdm2 reconnect failed: %r', e)
+                continue
+            self.read_task = asyncio.get_running_loop().create_task(self.readforever(self.reader,  self.writer))
+            logging.info('lcdm2 reconnected')
+            return
+
+    def connection_lost(self, exc):
+        self.writer = None
+        for resf in list(self.responces.values()) + [self.ask]:
+            if resf and not resf.done():
+                resf.set_exception(ConnectionError(repr(exc)))
+        self.reconnect()
 
     async def load(self, upper_count, lower_count):
         self.counters = [lower_count, upper_count]
 
+    def take(self, cassette, exited, rejected):
+        # rejected notes leave the cassette too
+        if self.counters[cassette] is not None:
+            self.counters[cassette] = max(0, self.counters[cassette] - exited - rejected)
+
+    def plan(self, ammount):
+        return plan(ammount, self.nominals, self.counters, combined=self.combined)
+
+    async def run_dispense(self, call, *args):
+        try:
+            return await call(*args)
+        except NotAccepted as e:
+            return {
+                'exit': 0,
+                'error': NOT_ACCEPTED,
+                'ok': False,
+                'description': repr(e)
+            }
+        except Exception as e:
+            # once ACKed the cycle may have run, whatever went wrong after
+            logging.error('dispense outcome unknown: %r', e)
+            return {
+                'exit': 0,
+                'error': UNKNOWN_OUTCOME,
+                'ok': False,
+                'description': repr(e)
+            }
+
     async def dispense(self, ammount):
+        async for progress in self.dispense_iter(ammount, sensors=False):
+            pass
+        return progress['result']
+
+    async def sensors(self):
+        try:
+            return (await self.status())['sensors']
+        except Exception as e:
+            logging.warning('no sensor state: %r', e)
+            return None
+
+    async def dispense_iter(self, ammount, sensors=True):
+        """Yield progress after every dispense cycle; the last item holds the result."""
         out = 0
         errors = []
-
-        for dispense_cmd, nominal in sorted(
-                zip( [self.lower_dispense, self.upper_dispense], self.nominals ),
-                reverse=True,
-                key=lambda x: x[1]
-        ):
-            result = {'error': 0}
-            if nominal:
-                count, _ = divmod(ammount, nominal)
-                while count:
-                    if count > 60:
-                        to_out = 50
-                    else:
-                        to_out = count
-                    try:
-                        result = await dispense_cmd(to_out)
-                    except serial.SerialException as e:
-                        result = {
-                            'exit': 0,
-                            'error': -1,
-                            'ok': False,
-                            'description': repr(e)
-                        }
-                    except Exception as e:
-                        result={
-                            'exit': 0,
-                            'error': -2,
-                            'description': repr(e),
-                            'ok': False
-                        }
-                    count -= result['exit']
-                    out += nominal * result['exit']
-                    ammount -= nominal * result['exit']
-                    if not result['ok']:
-                        errors.append((result['error'], result['description']))
-                        print('break 1')
-                        break
-            if result['error'] in [0, 0x30, 0x31, 0x38, 0x40]:
-                pass
+        dispense = [self.lower_dispense, self.upper_dispense]
+
+        notes = self.plan(ammount)
+        if notes is None:
+            result = {'out': 0, 'ok': False, 'errors': [(-3, 'amount can not be paid from cassettes')], 'plan': None}
+            yield {'event': 'done', 'result': result}
+            return
+        first = list(notes)
+        # a fresh trace per payout, kept until the next one starts
+        self.sensor_history = SensorHistory()
+        yield {'event': 'plan', 'plan': first, 'ammount': ammount}
+
+        while ammount and notes:
+            exits, rejects = [0] * len(notes), [0] * len(notes)
+            if self.combined and notes[0] and notes[1]:
+                lower, upper = (min(n, MAX_CYCLE) for n in notes)
+                result = await self.run_dispense(self.upper_lower_dispense, upper, lower)
+                if result['error'] in SPLIT_ERRORS:
+                    logging.warning('combined dispense failed, using single cassette commands: %s', result)
+                    self.combined = False
+                    notes = self.plan(ammount)
+                    continue
+                for i, name in enumerate(['lower', 'upper']):
+                    exits[i] = result.get(name, {}).get('exit', 0)
+                    rejects[i] = result.get(name, {}).get('reject', 0)
             else:
-                print('break2',result)
+                cassette = max(range(len(notes)), key=lambda i: (notes[i] > 0, self.nominals[i]))
+                if not notes[cassette]:
+                    break
+                result = await self.run_dispense(dispense[cassette], min(notes[cassette], MAX_CYCLE))
+                exits[cassette] = result['exit']
+                rejects[cassette] = result.get('reject', 0)
+            for i, nominal in enumerate(self.nominals):
+                self.take(i, exits[i], rejects[i])
+                notes[i] -= exits[i]
+                out += nominal * exits[i]
+                ammount -= nominal * exits[i]
+            yield {
+                'event': 'cycle',
+                'exit': exits,
+                'reject': rejects,
+                'out': out,
+                'left': ammount,
+                'error': result['error'],
+                'description': result.get('description'),
+                'sensors': await self.sensors() if sensors else None,
+            }
+            if result['ok'] and sum(exits):
+                continue
+            errors.append((result['error'], result['description']))
+            logging.warning('dispense stopped: %s', result)
+            if result['error'] not in CONTINUE_ERRORS:
                 break
-        
-        return { 'out': out, 'ok': ammount==0, 'errors': errors }
+            if result['error'] in END_ERRORS:
+                self.counters[END_ERRORS[result['error']]] = 0
+            elif not sum(exits):
+                # nothing came out and no cassette ran out: the same plan would do the same again
+                break
+            # short or empty cassette: pay the rest from what is left
+            notes = self.plan(ammount)
+            if notes is None:
+                errors.append((-3, 'amount can not be paid from cassettes'))
+
+        yield {'event': 'done', 'result': { 'out': out, 'ok': ammount==0, 'errors': errors, 'plan': first }}
 
     async def command_count(self, cmd, count):
         param = str(count).encode().rjust(2,b'0')
         return await self.command(cmd,param)
 
 
-    async def command(self, cmd, param):
-        await self.ask
-        ask = self.ask = asyncio.Future()
-        resf = self.responces[cmd] = asyncio.Future()
-        data = command(cmd, param)
+    async def send(self, data):
+        self.trace.tx(data)
+        if debug():
+            logging.debug('< %s', data.hex())
         self.writer.write(data)
         await self.writer.drain()
-        await timeouted(2, ask)
-        result = await  timeouted(60, resf)
-        return result
+        if self.metrics:
+            self.metrics.tx(len(data))
+
+    async def command(self, cmd, param):
+        if self.writer is None:
+            raise ConnectionError('lcdm2 %s not connected' % self.dev)
+        loop = asyncio.get_running_loop()
+        timeout = RESPONSE_TIMEOUT if cmd in SAFE_COMMANDS else DISPENSE_TIMEOUT
+        data = command(cmd, param)
+        async with self.lock:
+            start = loop.time()
+            for attempt in range(RETRIES):
+                ask = self.ask = loop.create_future()
+                resf = self.responces[cmd] = loop.create_future()
+                await self.send(data)
+                try:
+                    acked = await asyncio.wait_for(ask, ACK_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # a lost ACK may still be followed by the answer
+                    acked = None if cmd in SAFE_COMMANDS else True
+                    if self.metrics:
+                        self.metrics.error('ack_timeout')
+                if not acked:
+                    continue
+                try:
+                    result = await asyncio.wait_for(resf, timeout)
+                except asyncio.TimeoutError:
+                    if self.metrics:
+                        self.metrics.error('timeout')
+                    if cmd in SAFE_COMMANDS:
+                        continue
+                    self.trace.dump('timeout on 0x%02x' % cmd)
+                    raise
+                if self.metrics:
+                    self.metrics.observe(cmd, loop.time() - start)
+                return result
+            self.trace.dump('no answer to 0x%02x after %d tries' % (cmd, RETRIES))
+            raise NotAccepted('lcdm2 0x%02x not accepted' % cmd)
 
     async def upper_dispense(self, count):
         return await self.command_count(UPPER_DISPENSE, count)
@@ -190,11 +451,39 @@ class LCDM():
     async def lower_dispense(self, count):
         return await self.command_count(LOWER_DISPENSE, count)
 
+    async def upper_lower_dispense(self, upper, lower):
+        param = b'%02d%02d' % (upper, lower)
+        return await self.command(UPPER_LOWER_DISPENSE, param)
+
     async def status(self):
-        return await self.command(STATUS,b'')
+        resp = await self.command(STATUS,b'')
+        if isinstance(resp, dict) and 'sensors' in resp:
+            self.sensor_history.append(resp['sensors'])
+        return resp
+
+    async def sensors_changed(self):
+        """Poll STATUS and return only the sensors that changed since the last call."""
+        sensors = (await self.status())['sensors']
+        changed = sensors.changed(self.last_sensors)
+        self.last_sensors = sensors
+        return changed
+
+    def on_response(self, cmd, data):
+        resf = self.responces.get(cmd)
+        if resf is None or resf.done():
+            # the unit repeats an answer when our ACK got lost
+            if self.metrics:
+                self.metrics.error('duplicate')
+            return
+        try:
+            resf.set_result(self.set_results(cmd, data))
+        except Exception as e:
+            logging.error('bad response 0x%02x %s: %r', cmd, data.hex(), e)
+            resf.set_exception(e)
 
-    async def set_results(self,cmd,data):
-        print(cmd, data.hex())
+    def set_results(self,cmd,data):
+        if debug():
+            logging.debug('> %02x %s', cmd, data.hex())
 
         if cmd == STATUS:
             resp = {
@@ -203,7 +492,7 @@ class LCDM():
                 'error': data[1], 
                 'description':ERRORS[data[1]], 
                 'ok':data[1] in [0x30,0x31],
-                'sensors': sensors_parse(data[2:])
+                'sensors': Sensors.from_bytes(data[2:])
                 }
         elif cmd in [UPPER_DISPENSE, LOWER_DISPENSE, TEST_LOWER_DISPENSE, TEST_UPPER_DISPENSE]:
             resp = {
@@ -219,40 +508,84 @@ class LCDM():
                 'reject': int(data[6:8]),
                 'ok': data[5] in [0x30,0x31]
             }
+        elif cmd == UPPER_LOWER_DISPENSE and len(data) < 14:
+            # refused, e.g. "undefined command" on units without the combined mode
+            error = data[1] if len(data) > 1 else NOT_ACCEPTED
+            resp = {
+                'data': data,
+                'cmd': cmd,
+                'exit': 0,
+                'reject': 0,
+                'error': error,
+                'description': ERRORS.get(error, 'Short response'),
+                'ok': False
+            }
+        elif cmd == UPPER_LOWER_DISPENSE:
+            # upper chk, upper exit, lower chk, lower exit, error, status, upper reject, lower reject
+            resp = {
+                'data': data,
+                'cmd': cmd,
+                'upper': {'check': int(data[0:2]), 'exit': int(data[2:4]), 'reject': int(data[10:12])},
+                'lower': {'check': int(data[4:6]), 'exit': int(data[6:8]), 'reject': int(data[12:14])},
+                'error': data[8],
+                'description': ERRORS.get(data[8], 'Unknown error'),
+                'status': data[9],
+                'ok': data[8] in [0x30,0x31]
+            }
+            resp['exit'] = resp['upper']['exit'] + resp['lower']['exit']
+            resp['reject'] = resp['upper']['reject'] + resp['lower']['reject']
         else:
             resp = data.hex()
-        if self.responces.get(cmd):
-            self.responces.get(cmd).set_result(resp)
+        return resp
+
 
 
+    def on_ask(self, acked):
+        if self.ask is None or self.ask.done():
+            if self.metrics:
+                self.metrics.error('unexpected')
+            return
+        self.ask.set_result(acked)
 
     async def readforever(self, reader, writer):
         try:
             while True:
                 h = await reader.readexactly(1)
-                print(h)
                 h = h[0]
+                if self.metrics:
+                    self.metrics.rx(1)
+                if h in [ACK, NCK]:
+                    self.trace.rx(bytes([h]))
                 if h == ACK:
-                    self.ask.set_result(True)
+                    self.on_ask(True)
                 elif h == NCK:
-                    self.ask.set_result(False)
+                    if self.metrics:
+                        self.metrics.error('nak')
+                    self.on_ask(False)
                 elif h == SOH:
                     i,s,c =  await reader.readexactly(3)
                     data = await reader.readuntil(bytes([ETX]))
                     b = await reader.readexactly(1)
                     bcc = bytes([reduce(xor, [h,i,s,c,*list(data)])])
+                    self.trace.rx(bytes([h,i,s,c]) + data + b)
+                    if self.metrics:
+                        self.metrics.rx(len(data) + 4)
+                        self.metrics.tx(1)
                     if b==bcc:
                         writer.write(bytes([ACK]))
-                        await self.set_results(c,data[:-1])
+                        self.on_response(c, data[:-1])
                     else:
+                        if self.metrics:
+                            self.metrics.error('checksum')
+                        self.trace.dump('bad bcc', level=logging.WARNING)
                         writer.write(bytes([NCK]))
                     await writer.drain()
                 else:
                     pass
-        except serial.SerialException as e:
-            print(repr(e))
-            loop = asyncio.get_running_loop()
-            loop.call_later(10, loop.create_task(self.open()))
+        except (serial.SerialException, asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.error(repr(e))
+            self.trace.dump('serial error')
+            self.connection_lost(e)
 
 
 
@@ -263,11 +596,12 @@ async def main():
     print(await l.status())
     print(await l.dispense(36000))
 
-    
-loop = asyncio.get_event_loop()
-loop.create_task(main())
-loop.run_forever()
-loop.close()
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.create_task(main())
+    loop.run_forever()
+    loop.close()
 
 """
 ser = serial.Serial('/dev/ttyUSB0', 19200, timeout=5, rtscts=0, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from . import protocol, emulator
+
+
+# amount, nominals, counters, combined, expected notes per cassette
+PLAN_CASES = [
+    # one cycle of 35 notes beats two cycles of 8
+    (3500, [100, 1000], None, False, [35, 0]),
+    (3500, [100, 1000], [20, 100], False, [5, 3]),
+    (3500, [100, 1000], [4, 100], False, None),
+    (0, [100, 1000], None, False, [0, 0]),
+    (150, [100, 1000], None, False, None),
+    (7000, [100, 1000], [100, 0], False, [70, 0]),
+    # both cassettes in one combined cycle instead of two single ones
+    (66000, [100, 1000], None, False, [0, 66]),
+    (66000, [100, 1000], None, True, [60, 60]),
+    (299900, [100, 500, 1000, 5000], [2000] * 4, False, [49, 0, 0, 59]),
+]
+
+
+@pytest.mark.parametrize('amount, nominals, counters, combined, expected', PLAN_CASES)
+def test_plan(amount, nominals, counters, combined, expected):
+    notes = protocol.plan(amount, nominals, counters, combined=combined)
+    assert notes == expected
+    if notes is not None:
+        assert sum(n * v for n, v in zip(notes, nominals)) == amount
+        assert all(c is None or n <= c for n, c in zip(notes, counters or [None] * len(notes)))
+
+
+class GarbledLCDM(protocol.LCDM):
+    """Fails to parse the combined answer, as with a firmware using another layout."""
+    def set_results(self, cmd, data):
+        if cmd == protocol.UPPER_LOWER_DISPENSE:
+            raise ValueError('unexpected layout %s' % data.hex())
+        return super().set_results(cmd, data)
+
+
+async def payout(amount, device, lcdm_class=protocol.LCDM, **kw):
+    """Dispense amount from an emulated unit, return the result, the value that left it and the cycles."""
+    server, device, url = await emulator.serve(device)
+    lcdm = lcdm_class(url, upper_nominal=1000, lower_nominal=100, **kw)
+    await (await lcdm.open())
+    before = dict(device.counts)
+    try:
+        result = await asyncio.wait_for(lcdm.dispense(amount), 30)
+    finally:
+        await lcdm.close()
+        server.close()
+    nominals = {protocol.UPPER_DISPENSE: 1000, protocol.LOWER_DISPENSE: 100}
+    taken = sum((before[cmd] - device.counts[cmd]) * nominals[cmd] for cmd in before)
+    return result, taken, device.cycles
+
+
+def run_payout(amount, device, **kw):
+    return asyncio.run(payout(amount, device, **kw))
+
+
+def test_dispense():
+    result, taken, n = run_payout(3500, emulator.Dispenser(upper=100, lower=100))
+    assert result['ok'] and result['out'] == taken == 3500, result
+
+
+def test_dispense_short_cassette():
+    # the rest is planned from the other cassette
+    result, taken, n = run_payout(5000, emulator.Dispenser(upper=100, lower=10), combined=False)
+    assert result['ok'] and result['out'] == taken == 5000, result
+    result, taken, n = run_payout(2500, emulator.Dispenser(upper=100, lower=3), combined=False)
+    assert not result['ok'] and result['out'] == taken == 300, result
+
+
+def test_dispense_all_rejected():
+    # stop instead of planning the same cycle again
+    result, taken, n = run_payout(300, emulator.Dispenser(upper=100, lower=100, reject_rate=1.0))
+    assert not result['ok'] and result['out'] == 0 and n == 1, (result, n)
+
+
+def test_dispense_combined_refused():
+    # "undefined command": split into single cassette cycles
+    result, taken, n = run_payout(1100, emulator.Dispenser(upper=100, lower=100, combined=False))
+    assert result['ok'] and result['out'] == taken == 1100, result
+
+
+def test_dispense_combined_unreadable():
+    # ACKed but unreadable: the notes are out, so the payout stops instead of paying again
+    result, taken, n = run_payout(1100, emulator.Dispenser(upper=100, lower=100), lcdm_class=GarbledLCDM)
+    assert not result['ok'] and taken == 1100 and n == 1, (result, taken, n)
+    assert result['errors'][0][0] == protocol.UNKNOWN_OUTCOME, result
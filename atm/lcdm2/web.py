@@ -0,0 +1,70 @@
+from aiohttp import web
+from . import protocol
+from ..web import dumps, HTTPUnreachable
+import asyncio
+import json
+
+
+async def status(request):
+    lcdm = request.app.lcdm
+    try:
+        data = await lcdm.status()
+    except (asyncio.CancelledError, asyncio.TimeoutError, ConnectionError) as e:
+        raise HTTPUnreachable(content_type="application/json", text=json.dumps({"error": repr(e)}))
+    return web.json_response(data, dumps=dumps)
+
+async def sensors(request):
+    lcdm = request.app.lcdm
+    try:
+        changed = await lcdm.sensors_changed()
+    except (asyncio.CancelledError, asyncio.TimeoutError, ConnectionError) as e:
+        raise HTTPUnreachable(content_type="application/json", text=json.dumps({"error": repr(e)}))
+    return web.json_response({
+        'sensors': int(lcdm.last_sensors),
+        'changed': changed,
+        'history': lcdm.sensor_history.as_list(),
+    }, dumps=dumps)
+
+async def dispense(request):
+    req = await request.json()
+    data = await request.app.lcdm.dispense(req['ammount'])
+    return web.json_response(data, dumps=dumps)
+
+async def dispense_stream(request):
+    # one JSON object per line as each cycle finishes, the last one has the result
+    req = await request.json()
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'application/x-ndjson',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await resp.prepare(request)
+    async for progress in request.app.lcdm.dispense_iter(req['ammount']):
+        try:
+            await resp.write((dumps(progress) + '\n').encode())
+        except ConnectionResetError:
+            # the notes are already moving, finish the payout without the client
+            pass
+    return resp
+
+async def load(request):
+    req = await request.json()
+    await request.app.lcdm.load(req.get('upper'), req.get('lower'))
+    return web.json_response({'nominals': request.app.lcdm.nominals, 'counters': request.app.lcdm.counters})
+
+async def shutdown(app):
+    await app.lcdm.close()
+
+async def setup(app, config):
+    port = config.get('com')
+    assert port, "No port in config"
+    app.lcdm = protocol.LCDM(port, upper_nominal=config.get('upper', 0), lower_nominal=config.get('lower', 0),
+                           combined=config.get('combined', True))
+    await app.lcdm.load(config.get('upper_count'), config.get('lower_count'))
+    await (await app.lcdm.open())
+    app.on_cleanup.append(shutdown)
+    app.router.add_post('/atm/lcdm2/status', status)
+    app.router.add_post('/atm/lcdm2/sensors', sensors)
+    app.router.add_post('/atm/lcdm2/dispense', dispense)
+    app.router.add_post('/atm/lcdm2/dispense_stream', dispense_stream)
+    app.router.add_post('/atm/lcdm2/load', load)
@@ -0,0 +1,107 @@
+import bisect
+import collections
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+enabled = True
+registry = []
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, driver, device, baudrate=None):
+        self.driver = driver
+        self.device = device
+        self.baudrate = baudrate
+        self.latency = collections.defaultdict(Histogram)
+        self.errors = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def observe(self, cmd, seconds):
+        self.latency[cmd].observe(seconds)
+
+    def error(self, kind, n=1):
+        self.errors[kind] += n
+
+    def rx(self, n):
+        self.bytes_in += n
+
+    def tx(self, n):
+        self.bytes_out += n
+
+
+def register(driver, device, baudrate=None):
+    if not enabled:
+        return None
+    m = Metrics(driver, str(device), baudrate)
+    registry.append(m)
+    return m
+
+
+def unregister(m):
+    if m in registry:
+        registry.remove(m)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**kw):
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in kw.items())
+
+
+def render(metrics=None):
+    metrics = registry if metrics is None else metrics
+    out = [
+        '# HELP atm_command_duration_seconds Device command round-trip time.',
+        '# TYPE atm_command_duration_seconds histogram',
+    ]
+    for m in metrics:
+        for cmd, h in sorted(m.latency.items()):
+            cmd = '0x%02x' % cmd if isinstance(cmd, int) else cmd
+            total = 0
+            for le, n in zip(BUCKETS + ('+Inf',), h.counts):
+                total += n
+                out.append('atm_command_duration_seconds_bucket%s %d' % (
+                    labels(driver=m.driver, device=m.device, command=cmd, le=le), total))
+            tags = labels(driver=m.driver, device=m.device, command=cmd)
+            out.append('atm_command_duration_seconds_sum%s %f' % (tags, h.sum))
+            out.append('atm_command_duration_seconds_count%s %d' % (tags, h.count))
+    out += [
+        '# HELP atm_errors_total Device timeouts, NAKs and framing errors.',
+        '# TYPE atm_errors_total counter',
+    ]
+    for m in metrics:
+        for kind, n in sorted(m.errors.items()):
+            out.append('atm_errors_total%s %d' % (labels(driver=m.driver, device=m.device, kind=kind), n))
+    out += [
+        '# HELP atm_bytes_total Bytes moved over the serial line.',
+        '# TYPE atm_bytes_total counter',
+    ]
+    for m in metrics:
+        out.append('atm_bytes_total%s %d' % (labels(driver=m.driver, device=m.device, direction='in'), m.bytes_in))
+        out.append('atm_bytes_total%s %d' % (labels(driver=m.driver, device=m.device, direction='out'), m.bytes_out))
+    out += [
+        '# HELP atm_bus_busy_seconds_total Line time used at the configured baudrate (10 bits per byte).',
+        '# TYPE atm_bus_busy_seconds_total counter',
+    ]
+    for m in metrics:
+        if m.baudrate:
+            out.append('atm_bus_busy_seconds_total%s %f' % (
+                labels(driver=m.driver, device=m.device), (m.bytes_in + m.bytes_out) * 10 / m.baudrate))
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,57 @@
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+from . import emulator
+from . import web as sber_web
+from ..bench import measure, report
+
+PINPADS = 2
+
+
+async def bench_bus(count=50, latency=0.05, failure_rate=0.02, decline_rate=0.1):
+    with tempfile.TemporaryDirectory() as tmp:
+        distp = emulator.dist(os.path.join(tmp, 'dist'), latency=latency,
+                              failure_rate=failure_rate, decline_rate=decline_rate)
+        app = web.Application()
+        await sber_web.setup(app, {
+            'dist': distp,
+            'install': os.path.join(tmp, 'install'),
+            'pinpads': ['/dev/null'] * PINPADS,
+            'settle_on_start': False,
+        })
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        url = 'http://%s:%d/atm/sber/acquiring' % (host, port)
+
+        statuses = collections.Counter()
+        results = {}
+        async with aiohttp.ClientSession() as session:
+            async def acquiring():
+                async with session.post(url, json={'ammount': 10}) as resp:
+                    statuses[(await resp.json())['status']] += 1
+            for concurrency in [1, PINPADS, 4 * PINPADS]:
+                results['acquiring x%d' % concurrency] = await measure(acquiring, count, concurrency)
+        results['statuses'] = dict(statuses)
+        await runner.cleanup()
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    results = asyncio.run(bench_bus(count))
+    print('statuses: %s' % results.pop('statuses'))
+    for title, result in results.items():
+        report('sb_pilot %s' % title, *result)
+
+
+if __name__ == "__main__":
+    main()
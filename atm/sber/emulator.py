@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""sb_pilot stand-in that answers without a PIN pad or a human.
+
+dist() builds a distribution directory with this file as its sb_pilot and
+the demo e/p files as templates, Pilot({'dist': path}) installs it like the
+real one. The settings live in emulator.json next to it.
+"""
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+ENCODING = 'koi8-r'
+SETTINGS = 'emulator.json'
+TEMPLATES = ['demo.e', 'demo.p', 'bad.e', 'bad.p']
+DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo')
+
+DEFAULTS = {
+    'latency': 0.05,
+    'jitter': 0.0,
+    # sb_pilot dies or leaves no answer
+    'failure_rate': 0.0,
+    'decline_rate': 0.0,
+    'declines': ['2000'],
+    'decline_text': 'ОТКАЗ',
+}
+
+
+def dist(path, **settings):
+    unknown = set(settings) - set(DEFAULTS)
+    assert not unknown, "Unknown settings %s" % ', '.join(sorted(unknown))
+    os.makedirs(path, exist_ok=True)
+    for name in TEMPLATES:
+        shutil.copyfile(os.path.join(DEMO, name), os.path.join(path, name))
+    shutil.copyfile(os.path.abspath(__file__), os.path.join(path, 'sb_pilot'))
+    os.chmod(os.path.join(path, 'sb_pilot'), 0o755)
+    with open(os.path.join(path, SETTINGS), 'w') as f:
+        json.dump(dict(DEFAULTS, **settings), f, ensure_ascii=False)
+    return path
+
+
+def load(path=SETTINGS):
+    try:
+        with open(path) as f:
+            return dict(DEFAULTS, **json.load(f))
+    except FileNotFoundError:
+        return dict(DEFAULTS)
+
+
+def read(name):
+    with open(name, 'rb') as f:
+        return f.read().decode(ENCODING).split('\r\n')
+
+
+def write(name, lines):
+    with open(name, 'wb') as f:
+        f.write('\r\n'.join(lines).encode(ENCODING))
+
+
+def approve(rnd, ammount, now):
+    e, p = read('demo.e'), read('demo.p')
+    fresh = {
+        e[3]: ''.join(rnd.choice('0123456789ABCDEFGHJKLMNPRSTUVWXYZ') for i in range(6)),
+        e[4]: '%04d' % rnd.randrange(1, 10000),
+        e[9]: '%012d' % rnd.randrange(10 ** 12),
+    }
+    e = [fresh.get(line, line) for line in e]
+    e[8] = now.strftime('%Y%m%d%H%M%S')
+    receipt = '\r\n'.join(p)
+    for old, new in fresh.items():
+        receipt = receipt.replace(old, new)
+    receipt = receipt.replace('27.01.22     15:13', now.strftime('%d.%m.%y     %H:%M'))
+    if ammount is not None:
+        receipt = receipt.replace('            1.00', '%16.2f' % (ammount / 100))
+    return e, receipt.split('\r\n')
+
+
+def decline(rnd, settings):
+    e, p = read('bad.e'), read('bad.p')
+    e[0] = '%s,%s' % (rnd.choice(settings['declines']), settings['decline_text'])
+    return e, p
+
+
+def main(args):
+    settings = load()
+    rnd = random.Random()
+    time.sleep(max(0, settings['latency'] + rnd.uniform(-1, 1) * settings['jitter']))
+    if rnd.random() < settings['failure_rate']:
+        print('sb_pilot emulator: no answer from the PIN pad', file=sys.stderr)
+        return 1
+
+    command = args[0] if args else '1'
+    if command == '1' and rnd.random() < settings['decline_rate']:
+        e, p = decline(rnd, settings)
+    else:
+        ammount = int(args[1]) if command == '1' and len(args) > 1 else None
+        e, p = approve(rnd, ammount, datetime.datetime.now())
+    write('p', p)
+    # e last, sb_pilot readers take its presence as the end of the operation
+    write('e', e)
+    return 0
+
+
+if __name__ == "__main__":
+    if os.path.basename(sys.argv[0]) == 'sb_pilot':
+        sys.exit(main(sys.argv[1:]))
+    # python -m atm.sber.emulator DIR [latency] [failure_rate] [decline_rate]
+    names = ['latency', 'failure_rate', 'decline_rate']
+    print(dist(sys.argv[1], **{name: float(v) for name, v in zip(names, sys.argv[2:])}))
@@ -0,0 +1,139 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from ..cache import CACHE_DIR
+
+STORE = os.path.join(CACHE_DIR, 'sb_pilot')
+MANIFEST = '.manifest.json'
+# sb_pilot rewrites these, every install keeps its own copy
+MUTABLE = ['*.ini', 'OPT*.R']
+EXECUTABLE = ['sb_pilot', 'upnixmn.out', 'posScheduler']
+
+
+def mutable(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in MUTABLE)
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dist_hash(distp, known=None):
+    """Version digest of distp and the {name: [size, mtime_ns, sha256]} it was built from.
+
+    Files whose size and mtime match known are not read again.
+    """
+    known = known or {}
+    h = hashlib.sha256()
+    files = {}
+    for name in sorted(os.listdir(distp)):
+        path = os.path.join(distp, name)
+        if not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        size, mtime, sha = (known.get(name) or [None] * 3)[:3]
+        if (size, mtime) != (st.st_size, st.st_mtime_ns):
+            sha = file_hash(path)
+        files[name] = [st.st_size, st.st_mtime_ns, sha]
+        h.update(name.encode() + b'\0' + sha.encode())
+    return h.hexdigest()[:16], files
+
+
+def store(distp, digest, root=STORE):
+    """Versioned read-only copy of the distribution, shared by all installs."""
+    storep = os.path.join(root, 'dist-%s' % digest)
+    if os.path.isdir(storep):
+        return storep
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.dist-', dir=root)
+    for name in os.listdir(distp):
+        path = os.path.join(distp, name)
+        if os.path.isfile(path):
+            shutil.copy2(path, os.path.join(tmp, name))
+            os.chmod(os.path.join(tmp, name), 0o555 if name in EXECUTABLE else 0o444)
+    try:
+        os.rename(tmp, storep)
+    except OSError:
+        # another process stored the same version first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return storep
+
+
+def prune(digest, root=STORE):
+    """Remove the stored versions other than digest.
+
+    Installs hold hard links or copies of their files, so an old store
+    directory is not needed once nothing installs from it anymore.
+    """
+    keep = 'dist-%s' % digest
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith('dist-') and name != keep:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def link(src, dst):
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def read_manifest(installp):
+    try:
+        with open(os.path.join(installp, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def install(distp, installp, com, root=STORE):
+    """Bring installp up to the distribution in distp, return True if anything changed."""
+    manifest = read_manifest(installp)
+    digest, files = dist_hash(distp, manifest.get('dist'))
+    fresh = manifest.get('hash') == digest and all(
+        os.path.exists(os.path.join(installp, name)) for name in manifest.get('files', [])
+    )
+    if not fresh:
+        storep = store(distp, digest, root)
+        os.makedirs(installp, exist_ok=True)
+        names = sorted(os.listdir(storep))
+        for name in names:
+            dst = os.path.join(installp, name)
+            if mutable(name):
+                # keep what sb_pilot wrote there, a new version only adds missing files
+                if not os.path.exists(dst):
+                    shutil.copyfile(os.path.join(storep, name), dst)
+            else:
+                link(os.path.join(storep, name), dst)
+        with open(os.path.join(installp, MANIFEST), 'w') as f:
+            json.dump({'hash': digest, 'files': names, 'dist': files}, f)
+        logging.info('sb_pilot %s installed into %s', digest, installp)
+        prune(digest, root)
+    elif manifest.get('dist') != files:
+        # same content with new mtimes, remember them so the next start skips hashing
+        with open(os.path.join(installp, MANIFEST), 'w') as f:
+            json.dump(dict(manifest, dist=files), f)
+
+    tty = os.path.join(installp, 'ttyS99')
+    if os.path.islink(tty) and os.readlink(tty) != com:
+        os.remove(tty)
+    if not os.path.lexists(tty):
+        os.symlink(com, tty)
+    return not fresh
@@ -1,107 +1,133 @@
+import asyncio
 import os
+import re
 import subprocess
-import codecs
-import datetime
-import shutil
-import tempfile
 
-class Pilot:
-    def __init__(self, config):
-        if config.get('demo'):
-            distp = os.path.join(os.path.dirname(__file__), 'demo')
-        else:
-            distp = os.path.join(os.path.dirname(__file__), 'sb_pilot')
-        self.installp = installp = config.get('install', tempfile.mkdtemp(prefix='sb_pilot'))
-        shutil.copytree(distp, installp, dirs_exist_ok=True)
-        os.chmod(os.path.join(installp, './sb_pilot' ), 0o555)
-        try:
-            os.chmod(os.path.join(installp, './upnixmn.out' ), 0o555)
-            os.chmod(os.path.join(installp, './posScheduler' ), 0o555)
-            os.symlink(config.get('com', '/dev/ttyPos0'), installp+'/ttyS99')
-        except:
-            pass
+from . import install
+from .result import PilotResult, ENCODING
 
-    def exec_sync(self):
-        pilot, e, p = self.run(7)
-        status, status_text = e[0].strip().split(',', maxsplit=1)
-        return {
-            'answer' : e,
-            'message': p,
-            'status': status,
-            'status_text': status_text,
-        }
 
-    def run(self, *a):
-        args = [str(i) for i in a]
-        cwd = os.getcwd()
-        os.chdir(self.installp)
-        try:
-            os.remove('e')
-            os.remove('p')
-        except FileNotFoundError:
-            pass
+class Slot:
+    """One sb_pilot install directory bound to one PIN pad.
 
-        pilot = subprocess.run(
-                ['./sb_pilot', *args],
-                capture_output=True,
-                encoding='koi8-r',
-                check=True
-            )
+    sb_pilot talks to the pad through ttyS99 and leaves its answer in the
+    e and p files of its working directory, so every pad needs its own
+    directory and only one operation at a time.
+    """
+    def __init__(self, index, distp, installp, com):
+        self.index = index
+        self.installp = installp
+        self.com = com
+        self.lock = asyncio.Lock()
+        install.install(distp, installp, com)
 
-        try:
-            e = codecs.open('e', encoding='koi8-r').read().splitlines()
-        except Exception as err:
-            return {'status_text': 'Нет ответа от терминала', 'status': '-2'}
+    def path(self, name):
+        return os.path.join(self.installp, name)
 
-        try:
-            p = codecs.open('p', encoding='koi8-r').read()
-        except:
-            p = 'Нет чека'
+    async def run(self, *args):
+        for name in ['e', 'p']:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
 
-        os.chdir(cwd)
-        return pilot, e, p
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                './sb_pilot', *args,
+                cwd=self.installp,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await proc.communicate()
+            except asyncio.CancelledError:
+                # shutting down: sb_pilot must not outlive the lock on its pad
+                proc.kill()
+                await proc.wait()
+                raise
+        except OSError as err:
+            return PilotResult('-1', str(err))
+        pilot = {
+            'returncode': proc.returncode,
+            'stdout': stdout.decode(ENCODING, errors='replace'),
+            'stderr': stderr.decode(ENCODING, errors='replace'),
+        }
+        if proc.returncode:
+            err = subprocess.CalledProcessError(proc.returncode, ['./sb_pilot', *args], stdout, stderr)
+            return PilotResult('-1', str(err), **pilot)
+        return PilotResult.read(self.installp, **pilot)
 
-    def exec_acquiring(self, ammount):
-        SBERFRAC = int(os.environ.get('SBERFRAC', '100'))
-        cwd = os.getcwd()
-        os.chdir(self.installp)
 
-        try:
-            pilot, e, p = self.run('1', str(int(ammount*SBERFRAC)))
-        except Exception as err:
-            status_text = str(err)
-            return {'status_text': status_text, 'status': '-1'}
+class Pilot:
+    def __init__(self, config):
+        if config.get('dist'):
+            distp = config['dist']
+        elif config.get('demo'):
+            distp = os.path.join(os.path.dirname(__file__), 'demo')
+        else:
+            distp = os.path.join(os.path.dirname(__file__), 'sb_pilot')
+        pinpads = config.get('pinpads') or [config.get('com', '/dev/ttyPos0')]
+        installp = config.get('install')
+        self.slots = [
+            Slot(i, distp, self.install_path(installp, i, com, len(pinpads)), com)
+            for i, com in enumerate(pinpads)
+        ]
+        self.installp = self.slots[0].installp
 
-        status, status_text = e[0].strip().split(',', maxsplit=1)
+    @staticmethod
+    def install_path(installp, index, com, count):
+        # stable per pad, so restarts reuse the directory instead of piling up temp dirs
+        if installp is None:
+            return os.path.join(install.STORE, 'install-%s' % re.sub(r'[^A-Za-z0-9_.]+', '_', com).strip('_'))
+        return installp if count == 1 else '%s-%d' % (installp, index)
 
-        if status == '2000':
-            p = 'Отмененно клиентом'
+    async def acquire(self, pinpad=None):
+        if pinpad is not None:
+            slot = self.slots[pinpad]
+            await slot.lock.acquire()
+            return slot
+        # any pad will do: take the first one that is not busy, else queue on all
+        for slot in self.slots:
+            if not slot.lock.locked():
+                await slot.lock.acquire()
+                return slot
+        waiters = [asyncio.ensure_future(slot.lock.acquire()) for slot in self.slots]
         try:
-            date = datetime.datetime.strptime(e[8].strip(), '%Y%m%d%H%M%S')
-        except ValueError:
-            date = datetime.datetime.now()
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            for slot in self.acquired(waiters):
+                slot.lock.release()
+            raise
+        # keep the first pad that came free, give back any other taken meanwhile
+        acquired = self.acquired(waiters)
+        for slot in acquired[1:]:
+            slot.lock.release()
+        return acquired[0]
 
-        dates = date.isoformat('T')
+    def acquired(self, waiters):
+        # stop queueing on the other pads, return the ones already locked
+        slots = []
+        for slot, waiter in zip(self.slots, waiters):
+            if not waiter.done():
+                waiter.cancel()
+            elif not waiter.cancelled() and waiter.exception() is None:
+                slots.append(slot)
+        return slots
 
-        ans = {
-            'type': 'electronicaly',
-            'answer' : e,
-            'message': p,
-            'status': status,
-            'status_text': status_text,
-            'card': e[1].strip(),
-            'auth': e[3].strip(),
-            'checkt': e[4].strip(),
-            'terminal': e[7].strip(),
-            'timet': dates,
-            'link': e[9].strip(),
-            'hash': e[10].strip(),
-            'merchant': e[13].strip()
-        }
+    async def run(self, *a, pinpad=None):
+        args = [str(i) for i in a]
+        slot = await self.acquire(pinpad)
+        # the pad is free again only once sb_pilot has exited, even if the caller gives up
+        task = asyncio.ensure_future(slot.run(*args))
+        task.add_done_callback(lambda t: slot.lock.release())
+        return await asyncio.shield(task)
 
-        if status == '0':
-            ans['ammount'] = ammount
-        else:
-            ans['ammount'] = 0
+    async def exec_sync(self, pinpad=None):
+        return (await self.run(7, pinpad=pinpad)).sync()
 
-        return ans
+    async def exec_acquiring(self, ammount, pinpad=None):
+        SBERFRAC = int(os.environ.get('SBERFRAC', '100'))
+        result = await self.run('1', str(int(ammount*SBERFRAC)), pinpad=pinpad)
+        if result.status == '-1':
+            return {'status_text': result.status_text, 'status': '-1'}
+        return result.sale(ammount)
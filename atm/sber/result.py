@@ -0,0 +1,111 @@
+import datetime
+import os
+
+ENCODING = 'koi8-r'
+
+NO_ANSWER = '-2', 'Нет ответа от терминала'
+NO_RECEIPT = 'Нет чека'
+CANCELLED = 'Отмененно клиентом'
+
+
+def text(value):
+    return value
+
+
+def timestamp(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y%m%d%H%M%S')
+    except ValueError:
+        return datetime.datetime.now()
+
+
+# e file lines after the "status,text" head: name, line, type
+E_FIELDS = [
+    ('card', 1, text),
+    ('expiry', 2, text),
+    ('auth', 3, text),
+    ('checkt', 4, text),
+    ('card_type', 5, text),
+    ('terminal', 7, text),
+    ('timet', 8, timestamp),
+    ('link', 9, text),
+    ('hash', 10, text),
+    ('merchant', 13, text),
+]
+
+
+class PilotResult:
+    """Outcome of one sb_pilot run: the e answer, the p receipt and the process."""
+    __slots__ = ('status', 'status_text', 'answer', 'message', 'returncode', 'stdout', 'stderr') + tuple(
+        name for name, line, kind in E_FIELDS)
+
+    def __init__(self, status, status_text, answer=(), message=NO_RECEIPT, returncode=0, stdout='', stderr=''):
+        self.status = status
+        self.status_text = status_text
+        self.answer = list(answer)
+        self.message = message
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        for name, line, kind in E_FIELDS:
+            value = self.answer[line].strip() if len(self.answer) > line else ''
+            setattr(self, name, kind(value))
+
+    @property
+    def ok(self):
+        return self.status == '0'
+
+    @classmethod
+    def parse(cls, e, p=None, **kw):
+        """Build from the raw bytes of e and p, None when the file is missing."""
+        if not e:
+            return cls(*NO_ANSWER, message=NO_RECEIPT if p is None else p.decode(ENCODING, 'replace'), **kw)
+        answer = e.decode(ENCODING, 'replace').splitlines()
+        status, _, status_text = answer[0].strip().partition(',')
+        if not status.lstrip('-').isdigit():
+            return cls(NO_ANSWER[0], 'Неверный ответ: %s' % answer[0], answer, **kw)
+        message = NO_RECEIPT if p is None else p.decode(ENCODING, 'replace')
+        return cls(status, status_text, answer, message, **kw)
+
+    @classmethod
+    def read(cls, path, **kw):
+        return cls.parse(read(os.path.join(path, 'e')), read(os.path.join(path, 'p')), **kw)
+
+    def sync(self):
+        return {
+            'answer' : self.answer,
+            'message': self.message,
+            'status': self.status,
+            'status_text': self.status_text,
+        }
+
+    def sale(self, ammount):
+        return {
+            'type': 'electronicaly',
+            'answer' : self.answer,
+            'message': CANCELLED if self.status == '2000' else self.message,
+            'status': self.status,
+            'status_text': self.status_text,
+            'card': self.card,
+            'auth': self.auth,
+            'checkt': self.checkt,
+            'terminal': self.terminal,
+            'timet': self.timet.isoformat('T'),
+            'link': self.link,
+            'hash': self.hash,
+            'merchant': self.merchant,
+            'ammount': ammount if self.ok else 0,
+        }
+
+    def _asdict(self):
+        out = {name: getattr(self, name) for name in self.__slots__}
+        out['timet'] = self.timet.isoformat('T')
+        return out
+
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
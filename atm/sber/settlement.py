@@ -0,0 +1,113 @@
+import asyncio
+import datetime
+import logging
+import os
+
+from .result import ENCODING
+
+SYNC = 7
+
+
+def read_ini(path):
+    """key=value lines of an sb_pilot ini file, ;-commented lines skipped."""
+    values = {}
+    try:
+        with open(path, encoding=ENCODING, errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith(';') or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                values[key.strip()] = value.strip()
+    except OSError:
+        pass
+    return values
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, '%H:%M:%S' if value.count(':') == 2 else '%H:%M').time()
+
+
+def next_run(times, now=None):
+    now = now or datetime.datetime.now()
+    runs = []
+    for t in times:
+        at = datetime.datetime.combine(now.date(), t)
+        if at <= now:
+            at += datetime.timedelta(days=1)
+        runs.append(at)
+    return min(runs) if runs else None
+
+
+class Settlement:
+    """End of day closing for every PIN pad, one pad at a time.
+
+    The run takes the same per-pad lock as a sale, so it waits for the sale
+    in progress and never overlaps one, while the other pads keep working.
+    """
+    def __init__(self, pilot, times=None, command=None):
+        hints = read_ini(os.path.join(pilot.installp, 'pinpad.ini'))
+        if times is None and hints.get('ScheduledTime'):
+            times = [hints['ScheduledTime']]
+        self.pilot = pilot
+        self.times = [parse_time(t) for t in times or []]
+        self.command = command or int(hints.get('ScheduledCommand', SYNC))
+        self.task = None
+        self.running = None
+        self.state = {
+            'running': False,
+            'pinpad': None,
+            'done': 0,
+            'total': len(pilot.slots),
+            'next': None,
+            'last': {},
+        }
+
+    def start(self):
+        if self.times and (self.task is None or self.task.done()):
+            self.task = asyncio.get_running_loop().create_task(self.scheduler())
+        return self.task
+
+    async def scheduler(self):
+        while True:
+            at = next_run(self.times)
+            self.state['next'] = at.isoformat('T')
+            await asyncio.sleep(max(0, (at - datetime.datetime.now()).total_seconds()))
+            await self.trigger()
+
+    def trigger(self):
+        # a second request while closing joins the run in progress
+        if self.running is None or self.running.done():
+            self.running = asyncio.get_running_loop().create_task(self.run())
+            self.state.update(running=True, done=0)
+        return self.running
+
+    async def run(self):
+        state = self.state
+        state.update(running=True, done=0, started=datetime.datetime.now().isoformat('T'))
+        try:
+            for slot in self.pilot.slots:
+                state['pinpad'] = slot.index
+                started = datetime.datetime.now()
+                try:
+                    result = await self.pilot.run(self.command, pinpad=slot.index)
+                    last = {'status': result.status, 'status_text': result.status_text}
+                except Exception as e:
+                    logging.exception(e)
+                    last = {'status': '-1', 'status_text': repr(e)}
+                if last['status'] != '0':
+                    logging.error('sb_pilot %s settlement failed: %s', slot.com, last)
+                last.update(
+                    started=started.isoformat('T'),
+                    finished=datetime.datetime.now().isoformat('T'),
+                )
+                state['last'][slot.index] = last
+                state['done'] += 1
+        finally:
+            state.update(running=False, pinpad=None)
+        return state
+
+    def close(self):
+        for task in [self.task, self.running]:
+            if task:
+                task.cancel()
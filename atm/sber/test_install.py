@@ -0,0 +1,32 @@
+import os
+
+from . import emulator, install
+
+
+def test_install_skips_hashing_unchanged(monkeypatch, tmp_path):
+    distp = emulator.dist(str(tmp_path / 'dist'))
+    root, installp = str(tmp_path / 'store'), str(tmp_path / 'install')
+    assert install.install(distp, installp, '/dev/null', root)
+
+    hashed = []
+    file_hash = install.file_hash
+    monkeypatch.setattr(install, 'file_hash', lambda path: hashed.append(path) or file_hash(path))
+    assert not install.install(distp, installp, '/dev/null', root)
+    assert hashed == []
+
+    with open(os.path.join(distp, 'demo.p'), 'a') as f:
+        f.write('\r\n')
+    assert install.install(distp, installp, '/dev/null', root)
+    assert hashed == [os.path.join(distp, 'demo.p')]
+
+
+def test_install_prunes_old_versions(tmp_path):
+    distp = emulator.dist(str(tmp_path / 'dist'))
+    root, installp = str(tmp_path / 'store'), str(tmp_path / 'install')
+    install.install(distp, installp, '/dev/null', root)
+    emulator.dist(distp, latency=0)
+    install.install(distp, installp, '/dev/null', root)
+    digest = install.read_manifest(installp)['hash']
+    assert [n for n in os.listdir(root) if n.startswith('dist-')] == ['dist-%s' % digest]
+    # the install keeps working off its own links
+    assert os.access(os.path.join(installp, 'sb_pilot'), os.X_OK)
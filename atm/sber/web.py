@@ -1,30 +1,42 @@
 from .protocol import Pilot
+from .settlement import Settlement
 from aiohttp import web
 import asyncio
 import logging
 
 async def acquiring(request):
     req = await request.json()
-    loop = asyncio.get_running_loop()
-    res = await loop.run_in_executor(None, request.app.sb_pilot.exec_acquiring, req['ammount'])
+    res = await request.app.sb_pilot.exec_acquiring(req['ammount'], pinpad=req.get('pinpad'))
     return web.json_response(res)
 
 async def sync(request):
     req = await request.json()
-    loop = asyncio.get_running_loop()
-    res = await loop.run_in_executor(None, request.app.sb_pilot.exec_sync)
+    res = await request.app.sb_pilot.exec_sync(pinpad=req.get('pinpad'))
     return web.json_response(res)
 
 async def runcmd(request):
     req = await request.json()
-    loop = asyncio.get_running_loop()
-    res = await loop.run_in_executor(None, request.app.sb_pilot.run, req['command'])
-    return web.json_response(res)   
+    res = await request.app.sb_pilot.run(req['command'], pinpad=req.get('pinpad'))
+    return web.json_response(res._asdict())
+
+async def settlement(request):
+    # POST starts the closing in the background, both report its progress
+    if request.method == 'POST':
+        request.app.sb_settlement.trigger()
+    return web.json_response(request.app.sb_settlement.state)
+
+async def shutdown(app):
+    app.sb_settlement.close()
 
 async def setup(app, config={}):
     app.sb_pilot = Pilot(config)
-    loop = asyncio.get_running_loop()
-    loop.call_soon(app.sb_pilot.run, 7)
+    app.sb_settlement = Settlement(app.sb_pilot, config.get('settlement'), config.get('settlement_command'))
+    if config.get('settle_on_start', True):
+        app.sb_settlement.trigger()
+    app.sb_settlement.start()
+    app.on_cleanup.append(shutdown)
     app.router.add_post('/atm/sber/acquiring', acquiring)
     app.router.add_post('/atm/sber/run', runcmd)
-    app.router.add_post('/atm/sber/sync', sync)
\ No newline at end of file
+    app.router.add_post('/atm/sber/sync', sync)
+    app.router.add_get('/atm/sber/settlement', settlement)
+    app.router.add_post('/atm/sber/settlement', settlement)
@@ -0,0 +1,49 @@
+import collections
+import logging
+import time
+
+TRACE_SIZE = 256
+DUMP_SIZE = 32
+
+registry = []
+
+
+def debug():
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+
+class WireTrace:
+    def __init__(self, name, size=TRACE_SIZE):
+        self.name = name
+        self.frames = collections.deque(maxlen=size)
+        registry.append(self)
+
+    def rx(self, data):
+        self.frames.append((time.time(), '>', data))
+
+    def tx(self, data):
+        self.frames.append((time.time(), '<', data))
+
+    def as_list(self, last=None):
+        frames = list(self.frames)[-last:] if last else self.frames
+        return [
+            {'time': t, 'dir': d, 'data': bytes(data).hex()}
+            for t, d, data in frames
+        ]
+
+    def dump(self, reason='', last=DUMP_SIZE, level=logging.ERROR):
+        if not logging.root.isEnabledFor(level) or not self.frames:
+            return
+        lines = [
+            '%.3f %s %s' % (f['time'], f['dir'], f['data'])
+            for f in self.as_list(last)
+        ]
+        logging.log(level, '%s wire trace %s\n%s', self.name, reason, '\n'.join(lines))
+
+    def close(self):
+        if self in registry:
+            registry.remove(self)
+
+
+def dump_all():
+    return {t.name: t.as_list() for t in registry}
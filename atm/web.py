@@ -0,0 +1,84 @@
+from aiohttp import web
+import importlib
+import logging
+import asyncio
+import json
+from . import metrics, trace
+
+
+DRIVERS = {
+    'cashcode': 'atm.cashcode.web',
+    'cctalk': 'atm.cctalk.web',
+    'lcdm2': 'atm.lcdm2.web',
+    'sber': 'atm.sber.web',
+}
+
+
+def dumps(o):
+    def enc(w):
+        if type(w) == bytes:
+            return w.hex()
+        elif hasattr(w, '_asdict'):
+            return w._asdict()
+        else:
+            return repr(w)
+    return json.dumps(o, default=enc)
+
+
+SETUP_TIMEOUT = 10
+
+
+class HTTPUnreachable(web.HTTPError):
+    status_code = 523
+
+
+async def prometheus(request):
+    return web.Response(body=metrics.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def wiretrace(request):
+    return web.json_response(trace.dump_all())
+
+
+async def setup_driver(app, name, config, timeout=SETUP_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        module = importlib.import_module(DRIVERS[name])
+        # drivers talk to their devices in background tasks, setup itself must not hang the site
+        await asyncio.wait_for(module.setup(app, config), timeout)
+    except asyncio.TimeoutError:
+        logging.error('%s setup took longer than %ss', name, timeout)
+        return False
+    except Exception as e:
+        logging.exception('%s setup failed: %r', name, e)
+        return False
+    logging.info('%s ready in %.2fs', name, loop.time() - start)
+    return True
+
+
+async def setup(app, config):
+    metrics.enabled = config.get('web', {}).get('metrics', True)
+    app.router.add_get('/metrics', prometheus)
+    app.router.add_get('/trace', wiretrace)
+    names = [name for name in DRIVERS if name in config]
+    timeout = config.get('web', {}).get('setup_timeout', SETUP_TIMEOUT)
+    results = await asyncio.gather(*[
+        setup_driver(app, name, config[name], timeout) for name in names
+    ])
+    app['drivers'] = dict(zip(names, results))
+    return app['drivers']
+
+
+async def main(path='config.ini'):
+    import toml
+    config = toml.load(path)
+    app = web.Application()
+    await setup(app, config)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    webconfig = config.get('web', {})
+    site = web.TCPSite(runner, webconfig.get('host', '0.0.0.0'), webconfig.get('port', 4801))
+    await site.start()
+    return site